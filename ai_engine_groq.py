@@ -1,39 +1,135 @@
+from functools import lru_cache
+from django.core.cache import cache
 from groq import Groq
+import hashlib
+import httpx
+import json
 import logging
 
 logger = logging.getLogger(__name__)
 
+FALLBACK_REPLY = (
+    "Sorry, I’m having trouble processing your request right now. "
+    "Please try again shortly."
+)
+
+# Where a streamed reply may be split into a separate WhatsApp message
+SENTENCE_BOUNDARIES = (". ", "? ", "! ", "\n")
+
+# Only the most recent turns are sent; older ones cost prompt tokens and decode time
+MAX_HISTORY_MESSAGES = 20
+
+# Hard per-request limit (connect is kept short so a dead route fails fast).
+# The SDK already retries timeouts, connection errors, 429 and 5xx with
+# jittered exponential backoff, and never retries other 4xx responses.
+REQUEST_TIMEOUT = httpx.Timeout(10.0, connect=2.0)
+MAX_RETRIES = 2
+
+MODEL = "llama3-70b-8192"   # strong + free
+
+# Identical prompts are answered from the Django cache for this long.
+# Sampling hotter than CACHE_MAX_TEMPERATURE is meant to vary, so it is never cached.
+CACHE_TIMEOUT = 3600
+CACHE_MAX_TEMPERATURE = 0.3
+
+
+@lru_cache(maxsize=4)
+def _get_client(api_key):
+    """One Groq client per API key, so its pooled HTTP connections are reused."""
+    return Groq(api_key=api_key, timeout=REQUEST_TIMEOUT, max_retries=MAX_RETRIES)
+
+
+@lru_cache(maxsize=32)
+def _system_message(system_prompt):
+    """Shared system message dict per distinct prompt (treated as read-only)."""
+    return {"role": "system", "content": system_prompt}
+
+
+def _cache_key(messages, temperature):
+    """Content hash of everything that determines the reply."""
+    payload = json.dumps([MODEL, temperature, messages], sort_keys=True)
+    digest = hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+    return f"groq:{digest}"
+
+
+def _last_boundary(text):
+    """Index just past the last sentence boundary in text, or 0 if there is none."""
+    return max(
+        (text.rfind(mark) + len(mark) for mark in SENTENCE_BOUNDARIES if mark in text),
+        default=0
+    )
+
+
 class GroqAIEngine:
     """Chat + context engine powered by Groq (free testing)."""
 
     def __init__(self, api_key):
-        self.client = Groq(api_key=api_key)
+        self.client = _get_client(api_key)
 
-    def run(self, system_prompt, conversation_history):
+    def run(self, system_prompt, conversation_history, temperature=0.2):
         """
         system_prompt: string
         conversation_history: list of {role: "user"/"assistant", content: "..."}
+
+        Returns the full reply; use stream() to start sending before it is done.
         """
+        return "".join(self.stream(system_prompt, conversation_history, temperature))
+
+    def stream(self, system_prompt, conversation_history, temperature=0.2):
+        """
+        Same arguments as run(), but yields the reply while it is generated.
+        Tokens are buffered and flushed on sentence boundaries so each chunk
+        is a sensible unit to send as a WhatsApp message.
+        """
+
+        sent_any = False
 
         try:
-            logger.info("Calling Groq API...")
+            messages = [
+                _system_message(system_prompt),
+                *conversation_history[-MAX_HISTORY_MESSAGES:]
+            ]
+
+            key = None
+            if temperature <= CACHE_MAX_TEMPERATURE:
+                key = _cache_key(messages, temperature)
+                cached = cache.get(key)
+                if cached is not None:
+                    logger.info("Groq reply served from cache")
+                    yield from cached
+                    return
 
-            messages = [{"role": "system", "content": system_prompt}]
-            messages += conversation_history
+            logger.info("Calling Groq API...")
 
             response = self.client.chat.completions.create(
-                model="llama3-70b-8192",   # strong + free
+                model=MODEL,
                 messages=messages,
-                temperature=0.2,
-                max_tokens=300
+                temperature=temperature,
+                max_tokens=300,
+                stream=True
             )
 
-            ai_reply = response.choices[0].message["content"]
-            return ai_reply
+            chunks = []
+            buffer = ""
+            for chunk in response:
+                buffer += chunk.choices[0].delta.content or ""
+                cut = _last_boundary(buffer)
+                if cut:
+                    sent_any = True
+                    chunks.append(buffer[:cut])
+                    yield buffer[:cut]
+                    buffer = buffer[cut:]
+
+            if buffer:
+                chunks.append(buffer)
+                yield buffer
+
+            # Only complete replies are cached, never the fallback
+            if key is not None:
+                cache.set(key, chunks, timeout=CACHE_TIMEOUT)
 
         except Exception as e:
             logger.error(f"Groq API Error: {e}")
-            return (
-                "Sorry, I’m having trouble processing your request right now. "
-                "Please try again shortly."
-            )
+            # Only apologise if the user hasn't already received part of a reply
+            if not sent_any:
+                yield FALLBACK_REPLY
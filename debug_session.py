@@ -13,177 +13,293 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'lifegate_backend.settings')
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 django.setup()
 
+from django.db.models import Count, Q
+from django.utils import timezone
+
 from whatsapp.models import PatientSession, MessageLog
 from whatsapp.session_manager import SessionManager
 
-def debug_session(phone_number):
-    """Debug a specific session"""
+DEFAULT_SESSION_LIMIT = 20
+DEFAULT_MESSAGE_LIMIT = 50
+SCAN_CHUNK_SIZE = 500
+
+STATE_TRANSITIONS = SessionManager.STATE_TRANSITIONS
+
+ACTIVE_STATES = frozenset(['COLLECTING_SYMPTOMS', 'AI_FOLLOWUP_QUESTIONS'])
+
+# ----- "What should happen next" hints, one per state -----
+
+def hint_new_user(session):
+    return ["Should show welcome message", "Transition to COLLECTING_PROFILE"]
+
+def hint_collecting_profile(session):
+    if not session.age:
+        return ["Should ask for age"]
+    if not session.gender:
+        return ["Should ask for gender"]
+    return ["Should transition to COLLECTING_SYMPTOMS"]
+
+def hint_collecting_symptoms(session):
+    return ["Should process symptom and ask follow-up", "Transition to AI_FOLLOWUP_QUESTIONS"]
+
+def hint_followup_questions(session):
+    q_count = session.session_data.get('question_count', 0)
+    lines = [f"Questions asked: {q_count}"]
+    if q_count >= 4:
+        lines += ["Should generate summary", "Transition to SUMMARY_AND_RECOMMENDATIONS"]
+    else:
+        lines.append("Should ask next question")
+    return lines
+
+def hint_default(session):
+    return [f"State: {session.state}"]
+
+STATE_HINTS = {
+    'NEW_USER': hint_new_user,
+    'COLLECTING_PROFILE': hint_collecting_profile,
+    'COLLECTING_SYMPTOMS': hint_collecting_symptoms,
+    'AI_FOLLOWUP_QUESTIONS': hint_followup_questions,
+}
+
+def parse_count(option, value, minimum):
+    """Integer value for a paging option; ValueError if missing, not a number or below minimum"""
+    if value is None or not value.isdigit() or int(value) < minimum:
+        raise ValueError(f"{option} needs a whole number of at least {minimum}")
+    return int(value)
+
+def parse_paging(args):
+    """
+    Pull --limit N / --offset M out of args, returning (args, limit, offset).
+    Raises ValueError for a missing, non-numeric or out-of-range value.
+    """
+    remaining = []
+    limit = None
+    offset = 0
+    args = iter(args)
+    for arg in args:
+        if arg == '--limit':
+            limit = parse_count(arg, next(args, None), 1)
+        elif arg == '--offset':
+            offset = parse_count(arg, next(args, None), 0)
+        else:
+            remaining.append(arg)
+    return remaining, limit, offset
+
+def emit(lines):
+    """Write collected output lines in one go instead of a print() per line"""
+    sys.stdout.write("\n".join(lines) + "\n")
+
+def debug_session(phone_number, limit=DEFAULT_MESSAGE_LIMIT):
+    """Debug a specific session (shows the last `limit` messages)"""
+    out = []
     
-    print("\n" + "="*60)
-    print(f"🔍 DEBUGGING SESSION: {phone_number}")
-    print("="*60)
+    out.append("\n" + "="*60)
+    out.append(f"🔍 DEBUGGING SESSION: {phone_number}")
+    out.append("="*60)
     
     try:
         # Get session
         session = PatientSession.objects.get(phone_number=phone_number)
         
-        print(f"\n📱 Session Info:")
-        print(f"   Phone: {session.phone_number}")
-        print(f"   State: {session.state}")
-        print(f"   Created: {session.created_at}")
-        print(f"   Last Message: {session.last_message_at}")
+        out.append(f"\n📱 Session Info:")
+        out.append(f"   Phone: {session.phone_number}")
+        out.append(f"   State: {session.state}")
+        out.append(f"   Created: {session.created_at}")
+        out.append(f"   Last Message: {session.last_message_at}")
         
-        print(f"\n👤 Profile:")
-        print(f"   Age: {session.age}")
-        print(f"   Gender: {session.gender}")
-        print(f"   Weight: {session.weight}")
-        print(f"   Medical History: {session.medical_history}")
+        out.append(f"\n👤 Profile:")
+        out.append(f"   Age: {session.age}")
+        out.append(f"   Gender: {session.gender}")
+        out.append(f"   Weight: {session.weight}")
+        out.append(f"   Medical History: {session.medical_history}")
         
-        print(f"\n💾 Session Data:")
+        out.append(f"\n💾 Session Data:")
         for key, value in session.session_data.items():
-            print(f"   {key}: {value}")
+            out.append(f"   {key}: {value}")
         
-        print(f"\n🔄 Escalation:")
-        print(f"   Escalated: {session.escalated_to_clinician}")
+        out.append(f"\n🔄 Escalation:")
+        out.append(f"   Escalated: {session.escalated_to_clinician}")
         if session.assigned_clinician:
-            print(f"   Clinician: {session.assigned_clinician.get_full_name()}")
+            out.append(f"   Clinician: {session.assigned_clinician.get_full_name()}")
         
-        # Get messages
-        messages = MessageLog.objects.filter(session=session).order_by('created_at')
+        # Get the most recent messages, displayed oldest first
+        messages = list(
+            MessageLog.objects.filter(session=session)
+            .select_related('clinician')
+            .order_by('-created_at')[:limit]
+        )
+        messages.reverse()
         
-        print(f"\n💬 Messages ({messages.count()}):")
+        out.append(f"\n💬 Messages (showing {len(messages)} of {session.message_count}):")
         for msg in messages:
             sender = "👤 User" if msg.is_from_user else "🤖 Bot"
             if msg.is_from_clinician:
                 sender = f"👨‍⚕️ {msg.clinician.username}"
             timestamp = msg.created_at.strftime("%H:%M:%S")
-            print(f"   [{timestamp}] {sender}: {msg.content[:60]}...")
+            out.append(f"   [{timestamp}] {sender}: {msg.content[:60]}...")
         
         # Test state transition
-        print(f"\n🔄 Testing State Transitions:")
-        mgr = SessionManager(phone_number)
-        current_state = mgr.get_current_state()
-        print(f"   Current: {current_state}")
+        out.append(f"\n🔄 Testing State Transitions:")
+        # Read the state from the row we already loaded; building a
+        # SessionManager would re-fetch it and bump last_message_at
+        current_state = session.state
+        out.append(f"   Current: {current_state}")
         
-        from whatsapp.session_manager import SessionManager
-        possible_next = SessionManager.STATE_TRANSITIONS.get(current_state, [])
-        print(f"   Possible next states: {possible_next}")
+        possible_next = sorted(STATE_TRANSITIONS.get(current_state, ()))
+        out.append(f"   Possible next states: {possible_next}")
         
         # Show what should happen next
-        print(f"\n💡 What Should Happen Next:")
-        if current_state == 'NEW_USER':
-            print("   ➜ Should show welcome message")
-            print("   ➜ Transition to COLLECTING_PROFILE")
-        elif current_state == 'COLLECTING_PROFILE':
-            if not session.age:
-                print("   ➜ Should ask for age")
-            elif not session.gender:
-                print("   ➜ Should ask for gender")
-            else:
-                print("   ➜ Should transition to COLLECTING_SYMPTOMS")
-        elif current_state == 'COLLECTING_SYMPTOMS':
-            print("   ➜ Should process symptom and ask follow-up")
-            print("   ➜ Transition to AI_FOLLOWUP_QUESTIONS")
-        elif current_state == 'AI_FOLLOWUP_QUESTIONS':
-            q_count = session.session_data.get('question_count', 0)
-            print(f"   ➜ Questions asked: {q_count}")
-            if q_count >= 4:
-                print("   ➜ Should generate summary")
-                print("   ➜ Transition to SUMMARY_AND_RECOMMENDATIONS")
-            else:
-                print("   ➜ Should ask next question")
-        else:
-            print(f"   ➜ State: {current_state}")
+        out.append(f"\n💡 What Should Happen Next:")
+        hint = STATE_HINTS.get(current_state, hint_default)
+        for line in hint(session):
+            out.append(f"   ➜ {line}")
         
     except PatientSession.DoesNotExist:
-        print(f"\n❌ No session found for {phone_number}")
-        print("\n💡 This means:")
-        print("   • User hasn't sent any messages yet")
-        print("   • Or phone number format is wrong")
-        print("\n📝 Try sending a WhatsApp message first")
+        out.append(f"\n❌ No session found for {phone_number}")
+        out.append("\n💡 This means:")
+        out.append("   • User hasn't sent any messages yet")
+        out.append("   • Or phone number format is wrong")
+        out.append("\n📝 Try sending a WhatsApp message first")
         
         # Show all sessions
         all_sessions = PatientSession.objects.all().order_by('-created_at')
-        if all_sessions.exists():
-            print(f"\n📋 Existing Sessions ({all_sessions.count()}):")
-            for sess in all_sessions[:5]:
-                print(f"   • {sess.phone_number} - {sess.state} - {sess.created_at.strftime('%Y-%m-%d %H:%M')}")
+        total = all_sessions.count()
+        if total:
+            out.append(f"\n📋 Existing Sessions ({total}):")
+            for sess in all_sessions[:5].iterator():
+                out.append(f"   • {sess.phone_number} - {sess.state} - {sess.created_at.strftime('%Y-%m-%d %H:%M')}")
     
-    print("\n" + "="*60 + "\n")
+    out.append("\n" + "="*60 + "\n")
+    emit(out)
+
+def reset_fields():
+    """Column values that put a session back to a fresh NEW_USER state"""
+    return {
+        'state': 'NEW_USER',
+        'age': None,
+        'gender': None,
+        'weight': None,
+        'medical_history': None,
+        'session_data': {},
+        'ai_overview': None,
+        'recommendation_plan': None,
+        'escalated_to_clinician': False,
+        'assigned_clinician': None,
+        'escalation_reason': None,
+        'updated_at': timezone.now(),
+    }
 
 def reset_session(phone_number):
     """Reset a session to start over"""
+    out = []
     
-    print(f"\n🔄 Resetting session: {phone_number}")
+    out.append(f"\n🔄 Resetting session: {phone_number}")
     
-    try:
-        session = PatientSession.objects.get(phone_number=phone_number)
-        
-        # Reset to NEW_USER state
-        session.state = 'NEW_USER'
-        session.age = None
-        session.gender = None
-        session.weight = None
-        session.medical_history = None
-        session.session_data = {}
-        session.ai_overview = None
-        session.recommendation_plan = None
-        session.escalated_to_clinician = False
-        session.assigned_clinician = None
-        session.escalation_reason = None
-        session.save()
-        
-        print("✅ Session reset successfully!")
-        print("   State: NEW_USER")
-        print("   Profile: Cleared")
-        print("   Session data: Cleared")
-        print("\n💬 Send a new WhatsApp message to start fresh")
-        
-    except PatientSession.DoesNotExist:
-        print("❌ Session not found")
+    # Single UPDATE of the reset columns; no SELECT or full-row save
+    updated = PatientSession.objects.filter(phone_number=phone_number).update(**reset_fields())
+    
+    if not updated:
+        out.append("❌ Session not found")
+        emit(out)
+        return
+    
+    out.append("✅ Session reset successfully!")
+    out.append("   State: NEW_USER")
+    out.append("   Profile: Cleared")
+    out.append("   Session data: Cleared")
+    out.append("\n💬 Send a new WhatsApp message to start fresh")
+    emit(out)
 
-def list_all_sessions():
-    """List all sessions"""
+def reset_all_sessions():
+    """Reset every session in one bulk UPDATE"""
+    out = []
     
-    print("\n" + "="*60)
-    print("📋 ALL SESSIONS")
-    print("="*60)
+    out.append("\n🔄 Resetting all sessions")
     
-    sessions = PatientSession.objects.all().order_by('-last_message_at')
+    updated = PatientSession.objects.update(**reset_fields())
     
-    if not sessions.exists():
-        print("\n❌ No sessions found")
-        print("   Start by sending a WhatsApp message")
+    out.append(f"✅ Reset {updated} session(s) to NEW_USER")
+    emit(out)
+
+def list_all_sessions(limit=DEFAULT_SESSION_LIMIT, offset=0):
+    """List sessions, most recently active first, one page at a time"""
+    out = []
+    
+    out.append("\n" + "="*60)
+    out.append("📋 ALL SESSIONS")
+    out.append("="*60)
+    
+    sessions = PatientSession.objects.order_by('-last_message_at')
+    
+    # Totals come from one aggregate query rather than classifying rows in Python
+    stats = PatientSession.objects.aggregate(
+        total=Count('pk'),
+        active=Count('pk', filter=Q(state__in=ACTIVE_STATES)),
+    )
+    total = stats['total']
+    if not total:
+        out.append("\n❌ No sessions found")
+        out.append("   Start by sending a WhatsApp message")
+        emit(out)
         return
     
-    print(f"\nTotal Sessions: {sessions.count()}\n")
+    # Stream the page through a cursor rather than caching every row
+    page = sessions[offset:offset + limit].iterator(chunk_size=SCAN_CHUNK_SIZE)
+    
+    out.append(f"\nTotal Sessions: {total} ({stats['active']} active)\n")
     
-    for sess in sessions:
-        status = "🟢" if sess.state in ['COLLECTING_SYMPTOMS', 'AI_FOLLOWUP_QUESTIONS'] else "⚪"
-        print(f"{status} {sess.phone_number}")
-        print(f"   State: {sess.state}")
-        print(f"   Profile: Age {sess.age}, {sess.gender}")
-        print(f"   Messages: {sess.messages.count()}")
-        print(f"   Last Active: {sess.last_message_at.strftime('%Y-%m-%d %H:%M:%S')}")
-        print()
+    for sess in page:
+        status = "🟢" if sess.state in ACTIVE_STATES else "⚪"
+        out.append(f"{status} {sess.phone_number}")
+        out.append(f"   State: {sess.state}")
+        out.append(f"   Profile: Age {sess.age}, {sess.gender}")
+        out.append(f"   Messages: {sess.message_count}")
+        out.append(f"   Last Active: {sess.last_message_at.strftime('%Y-%m-%d %H:%M:%S')}")
+        out.append("")
+    
+    shown = min(limit, max(total - offset, 0))
+    has_more = offset + limit < total
+    out.append(f"Showing {offset + 1 if shown else 0}-{offset + shown} of {total} (more: {'yes' if has_more else 'no'})")
+    if has_more:
+        out.append(f"   Next page: python debug_session.py --list --limit {limit} --offset {offset + limit}")
+    emit(out)
+
+def usage():
+    """Print the command-line help"""
+    out = []
+    out.append("\n📱 Usage:")
+    out.append("   python debug_session.py <phone_number>     - Debug specific session")
+    out.append("   python debug_session.py --list              - List all sessions")
+    out.append("   python debug_session.py <phone> --reset     - Reset a session")
+    out.append("   python debug_session.py --reset-all         - Reset every session")
+    out.append("\nOptions:")
+    out.append(f"   --limit N    Sessions/messages to show (default {DEFAULT_SESSION_LIMIT}/{DEFAULT_MESSAGE_LIMIT})")
+    out.append("   --offset M   Sessions to skip when listing")
+    out.append("\nExample:")
+    out.append("   python debug_session.py +1234567890")
+    out.append("   python debug_session.py --list --limit 10 --offset 10")
+    emit(out)
 
 def main():
-    if len(sys.argv) < 2:
-        print("\n📱 Usage:")
-        print("   python debug_session.py <phone_number>     - Debug specific session")
-        print("   python debug_session.py --list              - List all sessions")
-        print("   python debug_session.py <phone> --reset     - Reset a session")
-        print("\nExample:")
-        print("   python debug_session.py +1234567890")
-        print("   python debug_session.py --list")
+    try:
+        args, limit, offset = parse_paging(sys.argv[1:])
+    except ValueError as e:
+        emit([f"\n❌ {e}"])
+        usage()
+        sys.exit(2)
+    
+    if not args:
+        usage()
         return
     
-    if sys.argv[1] == '--list':
-        list_all_sessions()
-    elif len(sys.argv) == 3 and sys.argv[2] == '--reset':
-        reset_session(sys.argv[1])
+    if args[0] == '--list':
+        list_all_sessions(limit or DEFAULT_SESSION_LIMIT, offset)
+    elif args[0] == '--reset-all':
+        reset_all_sessions()
+    elif len(args) == 2 and args[1] == '--reset':
+        reset_session(args[0])
     else:
-        debug_session(sys.argv[1])
+        debug_session(args[0], limit or DEFAULT_MESSAGE_LIMIT)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,6 +1,13 @@
 
 from django.contrib import admin
-from .models import PatientSession, MessageLog, ClinicianAvailability, EscalationQueue
+from django.db.models.functions import Substr
+from .models import PatientSession, MessageLog, ClinicianAvailability, EscalationQueue, full_name
+
+
+def is_changelist(request):
+    """True when the admin request is for a model's list page"""
+    match = request.resolver_match
+    return bool(match and match.url_name and match.url_name.endswith('_changelist'))
 
 
 @admin.register(PatientSession)
@@ -10,7 +17,7 @@ class PatientSessionAdmin(admin.ModelAdmin):
     list_display = [
         'phone_number', 'state', 'age', 'gender',
         'escalated_to_clinician', 'assigned_clinician',
-        'created_at', 'last_message_at'
+        'message_count', 'created_at', 'last_message_at'
     ]
     
     list_filter = [
@@ -20,7 +27,9 @@ class PatientSessionAdmin(admin.ModelAdmin):
     
     search_fields = ['phone_number', 'escalation_reason']
     
-    readonly_fields = ['created_at', 'updated_at', 'last_message_at']
+    readonly_fields = ['message_count', 'created_at', 'updated_at', 'last_message_at']
+    
+    list_select_related = ['assigned_clinician']
     
     fieldsets = (
         ('Contact Information', {
@@ -40,14 +49,22 @@ class PatientSessionAdmin(admin.ModelAdmin):
             )
         }),
         ('Timestamps', {
-            'fields': ('created_at', 'updated_at', 'last_message_at'),
+            'fields': ('message_count', 'created_at', 'updated_at', 'last_message_at'),
             'classes': ('collapse',)
         })
     )
     
+    # Columns the changelist actually renders; skips the JSON/TEXT blobs
+    list_only_fields = [
+        'phone_number', 'state', 'age', 'gender', 'escalated_to_clinician',
+        'assigned_clinician__username', 'message_count', 'created_at', 'last_message_at'
+    ]
+    
     def get_queryset(self, request):
         qs = super().get_queryset(request)
-        return qs.select_related('assigned_clinician')
+        if is_changelist(request):
+            qs = qs.only(*self.list_only_fields)
+        return qs
 
 
 @admin.register(MessageLog)
@@ -71,6 +88,11 @@ class MessageLogAdmin(admin.ModelAdmin):
     
     readonly_fields = ['created_at']
     
+    list_select_related = ['session', 'clinician']
+
+    # Avoid rendering every session/user as a <select> option on the change form
+    raw_id_fields = ['session', 'clinician']
+
     date_hierarchy = 'created_at'
     
     def get_phone_number(self, obj):
@@ -79,18 +101,28 @@ class MessageLogAdmin(admin.ModelAdmin):
     get_phone_number.admin_order_field = 'session__phone_number'
     
     def get_clinician_name(self, obj):
-        if obj.clinician:
-            return obj.clinician.get_full_name()
-        return '-'
+        return obj.clinician_name or '-'
     get_clinician_name.short_description = 'Clinician'
     
+    PREVIEW_LENGTH = 50
+    
     def get_message_preview(self, obj):
-        return obj.content[:50] + '...' if len(obj.content) > 50 else obj.content
+        # `preview` holds one extra character so we know whether to add '...'
+        preview = obj.preview
+        if len(preview) > self.PREVIEW_LENGTH:
+            return preview[:self.PREVIEW_LENGTH] + '...'
+        return preview
     get_message_preview.short_description = 'Message'
     
     def get_queryset(self, request):
         qs = super().get_queryset(request)
-        return qs.select_related('session', 'clinician')
+        qs = qs.annotate(clinician_name=full_name('clinician'))
+        if is_changelist(request):
+            # Truncate in SQL so the list never transfers full message bodies
+            qs = qs.annotate(
+                preview=Substr('content', 1, self.PREVIEW_LENGTH + 1)
+            ).defer('content')
+        return qs
 
 
 @admin.register(EscalationQueue)
@@ -113,6 +145,8 @@ class EscalationQueueAdmin(admin.ModelAdmin):
     
     readonly_fields = ['created_at', 'assigned_at', 'resolved_at']
     
+    list_select_related = ['session', 'assigned_to']
+    
     fieldsets = (
         ('Escalation Details', {
             'fields': ('session', 'priority', 'reason')
@@ -136,14 +170,12 @@ class EscalationQueueAdmin(admin.ModelAdmin):
     get_phone_number.admin_order_field = 'session__phone_number'
     
     def get_assigned_to(self, obj):
-        if obj.assigned_to:
-            return obj.assigned_to.get_full_name()
-        return 'Unassigned'
+        return obj.assigned_name or 'Unassigned'
     get_assigned_to.short_description = 'Assigned To'
     
     def get_queryset(self, request):
         qs = super().get_queryset(request)
-        return qs.select_related('session', 'assigned_to')
+        return qs.annotate(assigned_name=full_name('assigned_to'))
 
 
 @admin.register(ClinicianAvailability)
@@ -164,11 +196,13 @@ class ClinicianAvailabilityAdmin(admin.ModelAdmin):
     
     readonly_fields = ['last_active']
     
+    list_select_related = ['clinician']
+    
     def get_clinician_name(self, obj):
-        return obj.clinician.get_full_name()
+        return obj.clinician_name
     get_clinician_name.short_description = 'Clinician'
     get_clinician_name.admin_order_field = 'clinician__first_name'
     
     def get_queryset(self, request):
         qs = super().get_queryset(request)
-        return qs.select_related('clinician')
\ No newline at end of file
+        return qs.annotate(clinician_name=full_name('clinician'))
\ No newline at end of file
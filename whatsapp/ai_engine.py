@@ -1,9 +1,257 @@
+import hashlib
 import json
+import logging
 import os
+import re
 import requests
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import Dict, List
+import httpx
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
 from openai import OpenAI
-from groq import Groq
+from groq import NOT_GIVEN, APIConnectionError, APIStatusError, DefaultHttpxClient, Groq
+
+try:
+    import orjson  # optional, much faster C parser/serializer
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# Connection pool shared by every AIEngineComplete; sized for concurrent webhooks
+GROQ_CONNECTION_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20)
+
+# A stuck request must not hold a worker: fail fast on connect, 8s otherwise.
+# The SDK retries timeouts, connection errors, 429 and 5xx with jittered
+# backoff; one retry keeps the worst case bounded.
+GROQ_TIMEOUT = httpx.Timeout(8.0, connect=2.0)
+GROQ_MAX_RETRIES = 1
+
+# After this many consecutive provider failures, skip straight to the
+# fallback replies for GROQ_BREAKER_COOLDOWN seconds, then try one probe
+GROQ_BREAKER_THRESHOLD = 5
+GROQ_BREAKER_COOLDOWN = 30
+
+
+@lru_cache(maxsize=1)
+def _get_groq_client() -> Groq:
+    """
+    Process-wide Groq client. Building it per engine would throw away the
+    pooled keep-alive connections and pay a new TLS handshake per message.
+    """
+    return Groq(
+        api_key=os.environ.get("GROQ_API_KEY"),
+        http_client=DefaultHttpxClient(limits=GROQ_CONNECTION_LIMITS),
+        timeout=GROQ_TIMEOUT,
+        max_retries=GROQ_MAX_RETRIES,
+    )
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures and stays open for `cooldown`
+    seconds. After that it is half-open: one probe request goes through while
+    the rest keep failing fast, and the probe's outcome closes or reopens it.
+    """
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._open_until = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def closed(self) -> bool:
+        """Healthy; unlike allow(), never claims the half-open probe"""
+        with self._lock:
+            return self._failures < self.threshold
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._failures < self.threshold:
+                return True
+            if self._probing or time.monotonic() < self._open_until:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.threshold:
+                # A failed probe reopens the breaker for another full cooldown
+                self._open_until = time.monotonic() + self.cooldown
+                self._probing = False
+
+    def release(self):
+        """The call ended without saying anything about the provider's health"""
+        with self._lock:
+            self._probing = False
+
+
+_groq_breaker = CircuitBreaker(GROQ_BREAKER_THRESHOLD, GROQ_BREAKER_COOLDOWN)
+
+# Single-flight: how long a call may hold the lock, how long followers wait
+# for its result, and how long the result stays around for late duplicates
+SINGLEFLIGHT_LOCK_TIMEOUT = 15
+SINGLEFLIGHT_WAIT = 10
+SINGLEFLIGHT_POLL_INTERVAL = 0.1
+SINGLEFLIGHT_RESULT_TIMEOUT = 60
+
+
+def _singleflight_key(system_prompt: str, conversation: List[Dict], max_tokens: int, user: str) -> str:
+    payload = _json_dumps([system_prompt, conversation, max_tokens, user])
+    return f"llm:{hashlib.blake2b(payload, digest_size=16).hexdigest()}"
+
+
+def _is_provider_failure(error: Exception) -> bool:
+    """Outage-type errors; a 400 for a bad request says nothing about Groq's health"""
+    if isinstance(error, APIConnectionError):  # includes timeouts
+        return True
+    return isinstance(error, APIStatusError) and (error.status_code == 429 or error.status_code >= 500)
+
+
+# Speculative calls queued or running at once; past this, new ones are skipped
+PREFETCH_WORKERS = 4
+PREFETCH_MAX_PENDING = 8
+
+
+@lru_cache(maxsize=1)
+def _get_prefetch_pool() -> ThreadPoolExecutor:
+    """Background threads for speculative follow-up calls."""
+    return ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="groq-prefetch")
+
+
+@lru_cache(maxsize=1)
+def _get_prefetch_slots() -> threading.BoundedSemaphore:
+    """One slot per queued or running prefetch, so the pool's queue can't grow without bound"""
+    return threading.BoundedSemaphore(PREFETCH_MAX_PENDING)
+
+
+def _reset_after_fork():
+    _get_groq_client.cache_clear()
+    _get_prefetch_pool.cache_clear()
+    _get_prefetch_slots.cache_clear()
+    get_ai_engine.cache_clear()
+
+
+# Sockets and threads must not be shared across a fork (e.g. preforking workers)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+SYMPTOM_SYSTEM_PROMPT = """You are a medical AI assistant conducting a patient triage interview.
+
+Your role:
+- Ask ONE clear, clinical follow-up question
+- Be empathetic and professional
+- Focus on onset, duration, severity, associated symptoms
+- Respond ONLY with JSON in this format:
+
+{
+  "question": "Your follow-up question",
+  "should_escalate": false,
+  "escalation_reason": ""
+}
+
+Red flags requiring escalation:
+- Chest pain
+- Breathing difficulty
+- Stroke signs
+- Heavy bleeding
+- Loss of consciousness
+"""
+
+FOLLOWUP_SYSTEM_PROMPT = """You are continuing a medical triage interview. 
+Ask ONE additional follow-up question.
+
+Respond ONLY with:
+
+{
+  "question": "Next question OR empty string",
+  "sufficient_info": false,
+  "should_escalate": false,
+  "escalation_reason": ""
+}
+"""
+
+# First-question answers are shared between patients who describe the same
+# complaint with the same age and gender; the prompt hash keys out prompt edits
+SYMPTOM_PROMPT_ID = hashlib.sha256(SYMPTOM_SYSTEM_PROMPT.encode()).hexdigest()[:16]
+ANSWER_CACHE_TIMEOUT = 6 * 60 * 60
+_NON_WORD = re.compile(r"[^a-z0-9]+")
+
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _json_dumps(obj) -> bytes:
+    return orjson.dumps(obj) if orjson else json.dumps(obj).encode()
+
+# Profile parsing
+_AGE_RE = re.compile(r'\b(\d{1,3})\b')
+_WORD_RE = re.compile(r"[a-z]+")
+_MALE_WORDS = frozenset(['male', 'man', 'boy', 'm'])
+_FEMALE_WORDS = frozenset(['female', 'woman', 'girl', 'f'])
+
+# Matched as substrings of the lowercased message, in one regex scan
+CLINICIAN_KEYWORDS = ['doctor', 'clinician', 'speak to doctor', 'human']
+_CLINICIAN_RE = re.compile('|'.join(map(re.escape, CLINICIAN_KEYWORDS)))
+
+# The next follow-up question is requested in the background as soon as the
+# current one is sent, assuming the patient answers SPECULATIVE_PLACEHOLDER.
+# It is only used when the real reply is just as non-committal.
+SPECULATIVE_PLACEHOLDER = "I'm not sure."
+SPECULATIVE_TIMEOUT = 300
+NONCOMMITTAL_REPLIES = frozenset([
+    'not sure', "i'm not sure", 'im not sure', "i don't know", 'i dont know',
+    'idk', 'dunno', 'no idea', 'maybe',
+])
+
+
+def _read_until_json_closes(pieces) -> str:
+    """
+    Join streamed text, stopping once the first JSON object closes. Like
+    _parse_json_response, it starts at the first '{', so brackets in any
+    prose before it are not counted; neither are brackets inside JSON
+    strings. If the stream ends first, everything received is returned for
+    the parser to reject.
+    """
+    received = []
+    depth = 0
+    in_string = escaped = False
+
+    for piece in pieces:
+        for i, ch in enumerate(piece):
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif ch == '\\':
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"':
+                in_string = depth > 0
+            elif ch == '{' or (ch == '[' and depth):
+                depth += 1
+            elif ch in '}]' and depth:
+                depth -= 1
+                if not depth:
+                    received.append(piece[:i + 1])
+                    return "".join(received)
+        received.append(piece)
+
+    return "".join(received)
+
 
 class AIEngineComplete:
     """
@@ -21,11 +269,11 @@ class AIEngineComplete:
     
     
     def __init__(self):
-        self.client = Groq(api_key=os.environ.get("GROQ_API_KEY"))
+        self.client = _get_groq_client()
         self.model = "llama-3.3-70b-versatile"   
 
         if not os.environ.get("GROQ_API_KEY"):
-            print("⚠️ WARNING: No GROQ_API_KEY found. Using fallback responses.")
+            logger.warning("No GROQ_API_KEY found. Using fallback responses.")
 
     # =====================================================================
     #  OPENAI API CALL 
@@ -85,7 +333,42 @@ class AIEngineComplete:
     #             "fallback": True
     #         }
     
-    def _call_openai_api(self, system_prompt: str, conversation: List[Dict], max_tokens: int = 1000):
+    def _call_openai_api(self, system_prompt: str, conversation: List[Dict], max_tokens: int = 1000,
+                         user: str = None, speculative: bool = False):
+        """
+        Single-flight wrapper: identical concurrent requests (Twilio webhook
+        retries, duplicate deliveries) share one Groq call. The first caller
+        takes a cache lock and publishes its text; the others wait for it.
+
+        speculative: a background call nobody is waiting on; its outcome is
+        kept out of the circuit breaker's failure count.
+        """
+        key = _singleflight_key(system_prompt, conversation, max_tokens, user)
+        result_key, lock_key = f"{key}:result", f"{key}:lock"
+
+        deadline = time.monotonic() + SINGLEFLIGHT_WAIT
+        while True:
+            text = cache.get(result_key)
+            if text is not None:
+                logger.debug("Reusing in-flight Groq result")
+                return {"success": True, "text": text, "usage": None, "model": self.model}
+
+            if cache.add(lock_key, 1, timeout=SINGLEFLIGHT_LOCK_TIMEOUT):
+                try:
+                    result = self._request_completion(system_prompt, conversation, max_tokens, user, speculative)
+                    if result.get("success"):
+                        cache.set(result_key, result["text"], timeout=SINGLEFLIGHT_RESULT_TIMEOUT)
+                    return result
+                finally:
+                    cache.delete(lock_key)
+
+            if time.monotonic() >= deadline:
+                # Waited long enough on someone else's call; make our own
+                return self._request_completion(system_prompt, conversation, max_tokens, user, speculative)
+            time.sleep(SINGLEFLIGHT_POLL_INTERVAL)
+
+    def _request_completion(self, system_prompt: str, conversation: List[Dict], max_tokens: int,
+                            user: str = None, speculative: bool = False):
 
         if not os.environ.get("GROQ_API_KEY"):
             return {
@@ -94,10 +377,18 @@ class AIEngineComplete:
                 "fallback": True
             }
 
+        if not (_groq_breaker.closed() if speculative else _groq_breaker.allow()):
+            return {
+                "success": False,
+                "error": "Groq circuit open",
+                "fallback": True
+            }
+
         try:
-            print("\n🤖 Calling Groq API...")
-            print(f"   System prompt length: {len(system_prompt)} chars")
-            print(f"   Conversation messages: {len(conversation)}")
+            logger.debug(
+                "Calling Groq API (system prompt %d chars, %d messages)",
+                len(system_prompt), len(conversation)
+            )
 
             # Convert conversation to Groq chat format
             messages = [{"role": "system", "content": system_prompt}]
@@ -107,26 +398,43 @@ class AIEngineComplete:
                     "content": msg["content"]
                 })
 
-            # Groq chat completion call
+            # Groq chat completion call, streamed so we can hang up as soon
+            # as the JSON reply is complete instead of waiting for the end
             response = self.client.chat.completions.create(
                 model=self.model,
                 messages=messages,
                 max_tokens=max_tokens,
-                temperature=0.2
+                temperature=0.2,
+                user=user or NOT_GIVEN,
+                stream=True
             )
 
-            text = response.choices[0].message.content
-            print(f"✅ Groq responded: {text[:100]}...")
+            try:
+                text = _read_until_json_closes(
+                    chunk.choices[0].delta.content or ""
+                    for chunk in response if chunk.choices
+                )
+            finally:
+                response.close()
+
+            logger.debug("Groq responded: %.100s", text)
+            if not speculative:
+                _groq_breaker.record_success()
 
             return {
                 "success": True,
                 "text": text,
-                "usage": response.usage,
+                "usage": None,  # only reported on the final chunk, which we may skip
                 "model": self.model
             }
 
         except Exception as e:
-            print(f"❌ Groq API call failed: {str(e)}")
+            logger.error("Groq API call failed: %s", e)
+            if not speculative:
+                if _is_provider_failure(e):
+                    _groq_breaker.record_failure()
+                else:
+                    _groq_breaker.release()
             return {
                 "success": False,
                 "error": str(e),
@@ -167,34 +475,22 @@ class AIEngineComplete:
             'data_to_store': {}
         }
 
+    async def agenerate_response(self, session_context: Dict, user_message: str, state: str) -> Dict:
+        """
+        Awaitable generate_response() for async views. The handlers only touch
+        the Groq API (no ORM), so they run in a free worker thread and the
+        event loop keeps serving other conversations while this one waits.
+        """
+        return await sync_to_async(self.generate_response, thread_sensitive=False)(
+            session_context, user_message, state
+        )
+
     # =====================================================================
     #  SYMPTOM COLLECTION (NOW CALLS OPENAI)
     # =====================================================================
 
     def _handle_symptom_collection(self, context: Dict, message: str) -> Dict:
 
-        system_prompt = """You are a medical AI assistant conducting a patient triage interview.
-
-Your role:
-- Ask ONE clear, clinical follow-up question
-- Be empathetic and professional
-- Focus on onset, duration, severity, associated symptoms
-- Respond ONLY with JSON in this format:
-
-{
-  "question": "Your follow-up question",
-  "should_escalate": false,
-  "escalation_reason": ""
-}
-
-Red flags requiring escalation:
-- Chest pain
-- Breathing difficulty
-- Stroke signs
-- Heavy bleeding
-- Loss of consciousness
-"""
-
         profile = context.get("profile", {})
         conversation = [
             {
@@ -203,11 +499,21 @@ Red flags requiring escalation:
             }
         ]
 
-        result = self._call_openai_api(system_prompt, conversation)
+        answer_key = self._answer_cache_key(profile, message)
+        cached = cache.get(answer_key)
+        if cached is not None:
+            logger.debug("Using cached symptom answer")
+            result = {"success": True, "text": cached}
+        else:
+            result = self._call_openai_api(SYMPTOM_SYSTEM_PROMPT, conversation, user=self._api_user(context))
 
         if result.get("success"):
             try:
                 data = self._parse_json_response(result["text"])
+                if cached is None:
+                    cache.set(answer_key, result["text"], timeout=ANSWER_CACHE_TIMEOUT)
+                if not data["should_escalate"]:
+                    self._prefetch_followup(context, data["question"], 1)
                 return {
                     "response": data["question"],
                     "next_state": "AI_FOLLOWUP_QUESTIONS",
@@ -238,23 +544,12 @@ Red flags requiring escalation:
                 "data_to_store": {"assessment_complete": True}
             }
 
-        system_prompt = """You are continuing a medical triage interview. 
-Ask ONE additional follow-up question.
+        result = self._take_speculative_followup(context, message, question_count)
+        if result is None:
+            conversation = self._build_conversation_history(context)
+            conversation.append({"role": "user", "content": message})
 
-Respond ONLY with:
-
-{
-  "question": "Next question OR empty string",
-  "sufficient_info": false,
-  "should_escalate": false,
-  "escalation_reason": ""
-}
-"""
-
-        conversation = self._build_conversation_history(context)
-        conversation.append({"role": "user", "content": message})
-
-        result = self._call_openai_api(system_prompt, conversation)
+            result = self._call_openai_api(FOLLOWUP_SYSTEM_PROMPT, conversation, user=self._api_user(context))
 
         if result.get("success"):
             try:
@@ -268,6 +563,9 @@ Respond ONLY with:
                         "data_to_store": {"assessment_complete": True}
                     }
 
+                if not data["should_escalate"] and question_count + 1 < 5:
+                    self._prefetch_followup(context, data["question"], question_count + 1)
+
                 return {
                     "response": data["question"],
                     "next_state": "AI_FOLLOWUP_QUESTIONS",
@@ -281,15 +579,78 @@ Respond ONLY with:
 
         return self._fallback_followup_response(question_count)
 
+    def _answer_cache_key(self, profile: Dict, message: str) -> str:
+        """
+        Key on what the symptom prompt sees: the exact age and gender it is
+        sent, and the complaint's words. It carries no conversation history.
+        """
+        age, gender = profile.get('age', 'unknown'), profile.get('gender', 'unknown')
+        words = _NON_WORD.sub(" ", message.lower()).strip()
+        digest = hashlib.sha256(f"{age}\0{gender}\0{words}".encode()).hexdigest()[:32]
+        return f"answer_cache:{SYMPTOM_PROMPT_ID}:COLLECTING_SYMPTOMS:{digest}"
+
+    # =====================================================================
+    #  SPECULATIVE FOLLOW-UP PREFETCH
+    # =====================================================================
+
+    def _speculative_key(self, context: Dict, question_count: int) -> str:
+        return f"speculative:{context.get('session_id')}:{question_count}"
+
+    def _prefetch_followup(self, context: Dict, question: str, question_count: int):
+        """
+        Request the next follow-up in the background while the patient types.
+        Skipped when PREFETCH_MAX_PENDING calls are already queued or running.
+        """
+        if not context.get("session_id"):
+            return
+
+        slots = _get_prefetch_slots()
+        if not slots.acquire(blocking=False):
+            logger.debug("Prefetch queue full; skipping speculative follow-up")
+            return
+
+        conversation = self._build_conversation_history(context)
+        conversation.append({"role": "assistant", "content": question})
+        conversation.append({"role": "user", "content": SPECULATIVE_PLACEHOLDER})
+        key = self._speculative_key(context, question_count)
+
+        def prefetch():
+            try:
+                result = self._call_openai_api(
+                    FOLLOWUP_SYSTEM_PROMPT, conversation,
+                    user=self._api_user(context), speculative=True
+                )
+                if result.get("success"):
+                    cache.set(key, result["text"], timeout=SPECULATIVE_TIMEOUT)
+            finally:
+                slots.release()
+
+        try:
+            _get_prefetch_pool().submit(prefetch)
+        except RuntimeError:  # pool shut down at exit
+            slots.release()
+
+    def _take_speculative_followup(self, context: Dict, message: str, question_count: int):
+        """Prefetched API result for this turn, if the reply matches the assumption"""
+        key = self._speculative_key(context, question_count)
+        text = cache.get(key)
+        if text is None:
+            return None
+        cache.delete(key)
+
+        if message.strip().lower().rstrip('.!') not in NONCOMMITTAL_REPLIES:
+            return None
+
+        logger.debug("Using prefetched follow-up question")
+        return {"success": True, "text": text}
+
     # =====================================================================
     #  SUMMARY GENERATION 
     # =====================================================================
 
     def _handle_summary_generation(self, context: Dict) -> Dict:
 
-        print("\n==============================")
-        print("🏥 Generating Assessment (OpenAI)")
-        print("==============================")
+        logger.debug("Generating assessment")
 
         system_prompt = """You are a medical AI assistant creating a patient summary.
 
@@ -314,7 +675,7 @@ Rules:
         conversation = self._build_conversation_history(context)
         conversation.append({"role": "user", "content": "Generate full assessment summary."})
 
-        result = self._call_openai_api(system_prompt, conversation, max_tokens=2000)
+        result = self._call_openai_api(system_prompt, conversation, max_tokens=2000, user=self._api_user(context))
 
         if result.get("success"):
             try:
@@ -364,9 +725,36 @@ Rules:
 
         return messages
 
+    def _api_user(self, context: Dict):
+        """
+        Stable per-patient id for the API's `user` field, so one conversation's
+        calls can be grouped (and their shared prefix reused) without sending
+        the phone number itself.
+        """
+        phone = context.get("phone_number")
+        if not phone:
+            return None
+        return hashlib.sha256(phone.encode()).hexdigest()[:32]
+
     def _parse_json_response(self, text: str) -> Dict:
-        clean = text.strip().replace("```json", "").replace("```", "")
-        return json.loads(clean)
+        """
+        First JSON object in text, ignoring code fences or prose
+        around it. Decodes in place rather than copying the text to strip them.
+        """
+        # Common case: the reply is bare JSON (streaming already cut it at the close)
+        if orjson:
+            try:
+                return orjson.loads(text)
+            except orjson.JSONDecodeError:
+                pass
+
+        start = text.find("{")
+        if start != -1:
+            try:
+                return _JSON_DECODER.raw_decode(text, start)[0]
+            except json.JSONDecodeError:
+                pass
+        raise ValueError("No JSON found in model response")
 
     def _format_summary_response(self, summary: Dict) -> str:
         return f"""
@@ -490,8 +878,7 @@ Reply 'Start' to begin, or type 'doctor' anytime."""
         profile = context.get('profile', {})
         
         if not profile.get('age'):
-            import re
-            age_match = re.search(r'\b(\d{1,3})\b', message)
+            age_match = _AGE_RE.search(message)
             if age_match:
                 age = int(age_match.group(1))
                 if 0 < age < 120:
@@ -538,14 +925,19 @@ Reply 'Start' to begin, or type 'doctor' anytime."""
     
     def _extract_gender(self, message: str) -> str:
         """Extract gender"""
-        msg = message.lower()
-        if any(w in msg for w in ['male', 'man', 'boy', 'm']):
+        # Whole words only: substring checks read 'female' (or any 'm') as male
+        tokens = set(_WORD_RE.findall(message.lower()))
+        if tokens & _MALE_WORDS:
             return 'Male'
-        elif any(w in msg for w in ['female', 'woman', 'girl', 'f']):
+        elif tokens & _FEMALE_WORDS:
             return 'Female'
         return 'Other'
     
     def check_for_clinician_request(self, message: str) -> bool:
         """Check for clinician keywords"""
-        keywords = ['doctor', 'clinician', 'speak to doctor', 'human']
-        return any(k in message.lower() for k in keywords)
\ No newline at end of file
+        return _CLINICIAN_RE.search(message.lower()) is not None
+
+@lru_cache(maxsize=1)
+def get_ai_engine() -> AIEngineComplete:
+    """Shared engine; it only holds the process-wide Groq client"""
+    return AIEngineComplete()
@@ -1,21 +1,31 @@
+import enum
+import logging
+from functools import lru_cache
+
+from . import keywords
 from .models import EscalationQueue, ClinicianAvailability, PatientSession
 from django.contrib.auth.models import User
 from django.utils import timezone
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import F, Q
+
+logger = logging.getLogger(__name__)
+
+
+class AssignResult(enum.Enum):
+    """Outcome of ClinicianEscalation.assign_to_clinician()"""
+    ASSIGNED = 'assigned'
+    TAKEN = 'taken'              # already assigned or resolved by someone else
+    AT_CAPACITY = 'at_capacity'  # clinician has max_concurrent_cases open
+    NONE_PENDING = 'none_pending'  # assign_next_pending() found no open case
+    FAILED = 'failed'
+
 
 class ClinicianEscalation:
     """Handles escalation logic and clinician assignment"""
     
-    URGENT_KEYWORDS = [
-        'chest pain', 'can\'t breathe', 'difficulty breathing',
-        'severe pain', 'bleeding heavily', 'unconscious',
-        'seizure', 'stroke', 'heart attack', 'suicide'
-    ]
-    
-    HIGH_PRIORITY_KEYWORDS = [
-        'severe', 'intense', 'unbearable', 'emergency',
-        'very bad', 'getting worse', 'spreading'
-    ]
+    URGENT_KEYWORDS = keywords.URGENT_KEYWORDS
+    HIGH_PRIORITY_KEYWORDS = keywords.HIGH_PRIORITY_KEYWORDS
     
     def create_escalation(self, session: PatientSession, reason: str, ai_assessment: str = None) -> EscalationQueue:
         """Create an escalation request"""
@@ -49,19 +59,11 @@ class ClinicianEscalation:
     def _calculate_priority(self, session: PatientSession, reason: str) -> str:
         """Calculate escalation priority based on symptoms and context"""
         
-        # Get all messages from the session
-        all_messages = ' '.join([
-            msg.content.lower() 
-            for msg in session.messages.filter(is_from_user=True)
-        ])
-        
-        # Check for urgent keywords
-        if any(keyword in all_messages for keyword in self.URGENT_KEYWORDS):
-            return 'URGENT'
-        
-        # Check for high priority indicators
-        if any(keyword in all_messages for keyword in self.HIGH_PRIORITY_KEYWORDS):
-            return 'HIGH'
+        # Keyword priority is tracked as messages are logged (MessageLog.save());
+        # re-read it since this instance may predate the latest message
+        session.refresh_from_db(fields=['keyword_priority'])
+        if session.keyword_priority:
+            return session.keyword_priority
         
         # Check for vulnerable populations
         if session.age:
@@ -76,89 +78,168 @@ class ClinicianEscalation:
         # Default to medium priority
         return 'MEDIUM'
     
+    def keyword_priority(self, text: str):
+        """'URGENT' or 'HIGH' for the most serious keyword in (lowercased) text, else None"""
+        return keywords.keyword_priority(text)
+    
     def assign_to_available_clinician(self, escalation: EscalationQueue) -> bool:
         """Try to assign escalation to an available clinician"""
         
-        # Find available clinicians
-        available_clinicians = ClinicianAvailability.objects.filter(
-            is_available=True,
-            current_active_cases__lt=models.F('max_concurrent_cases')
-        ).select_related('clinician')
-        
-        if not available_clinicians.exists():
-            return False
-        
-        # Prioritize by workload (least busy first)
-        clinician_availability = available_clinicians.order_by('current_active_cases').first()
-        
-        if clinician_availability:
-            return self.assign_to_clinician(escalation, clinician_availability.clinician)
-        
-        return False
+        with transaction.atomic():
+            # Least busy clinician with spare capacity, in one locking query;
+            # rows already locked by a concurrent assignment are skipped
+            clinician_availability = (
+                ClinicianAvailability.objects
+                .select_for_update(skip_locked=True, of=('self',))
+                .filter(
+                    is_available=True,
+                    current_active_cases__lt=F('max_concurrent_cases')
+                )
+                .select_related('clinician')
+                .order_by('current_active_cases')
+                .first()
+            )
+            
+            if clinician_availability is None:
+                return False
+            
+            return self.assign_to_clinician(
+                escalation, clinician_availability.clinician, clinician_availability
+            ) is AssignResult.ASSIGNED
     
-    def assign_to_clinician(self, escalation: EscalationQueue, clinician: User) -> bool:
-        """Assign an escalation to a specific clinician"""
+    def assign_to_clinician(self, escalation: EscalationQueue, clinician: User,
+                            availability: ClinicianAvailability = None) -> AssignResult:
+        """
+        Assign an escalation to a specific clinician. The case is claimed with
+        an UPDATE that only matches while it is still open and unassigned,
+        so of two clinicians accepting it at once exactly one succeeds.
+        """
         
         try:
-            # Update escalation
-            escalation.assigned_to = clinician
-            escalation.assigned_at = timezone.now()
-            escalation.save()
+            with transaction.atomic():
+                # Claim a slot first; a clinician already at capacity can't take the case
+                if not self._reserve_capacity(clinician, availability):
+                    return AssignResult.AT_CAPACITY
+                
+                now = timezone.now()
+                claimed = EscalationQueue.objects.filter(
+                    pk=escalation.pk, assigned_to__isnull=True, is_resolved=False
+                ).update(assigned_to=clinician, assigned_at=now)
+                if not claimed:
+                    # Give the reserved slot back
+                    transaction.set_rollback(True)
+                    return AssignResult.TAKEN
+                
+                PatientSession.objects.filter(pk=escalation.session_id).update(
+                    assigned_clinician=clinician, state='CLINICIAN_CHAT_ACTIVE', updated_at=now
+                )
             
-            # Update session
-            session = escalation.session
-            session.assigned_clinician = clinician
-            session.state = 'CLINICIAN_CHAT_ACTIVE'
-            session.save()
-            
-            # Update clinician workload
-            availability = ClinicianAvailability.objects.get(clinician=clinician)
-            availability.current_active_cases += 1
-            availability.save()
+            escalation.assigned_to = clinician
+            escalation.assigned_at = now
+            if EscalationQueue.session.is_cached(escalation):
+                escalation.session.assigned_clinician = clinician
+                escalation.session.state = 'CLINICIAN_CHAT_ACTIVE'
             
             # Send notification to clinician (implementation depends on notification system)
             self._notify_clinician(clinician, escalation)
             
-            return True
+            return AssignResult.ASSIGNED
             
         except Exception as e:
-            print(f"Error assigning to clinician: {e}")
-            return False
+            logger.error("Error assigning to clinician: %s", e)
+            return AssignResult.FAILED
     
-    def resolve_escalation(self, escalation: EscalationQueue):
-        """Mark escalation as resolved and update clinician workload"""
+    def assign_next_pending(self, clinician: User):
+        """
+        Take the highest-priority unassigned escalation for `clinician`.
+        Rows locked by another clinician's pickup are skipped, so concurrent
+        pickups get different cases. Returns (AssignResult, escalation), the
+        escalation being None unless the result is ASSIGNED.
+        """
+        # Don't lock a case for a clinician who couldn't take it anyway;
+        # assign_to_clinician() still makes the authoritative check
+        if not self.has_capacity(clinician):
+            return AssignResult.AT_CAPACITY, None
         
-        escalation.is_resolved = True
-        escalation.resolved_at = timezone.now()
-        escalation.save()
+        with transaction.atomic():
+            escalation = (
+                self.get_pending_escalations()
+                .select_for_update(skip_locked=True, of=('self',))
+                .first()
+            )
+            if escalation is None:
+                return AssignResult.NONE_PENDING, None
+            result = self.assign_to_clinician(escalation, clinician)
+        return result, escalation if result is AssignResult.ASSIGNED else None
+    
+    def has_capacity(self, clinician: User) -> bool:
+        """Whether `clinician` is below max_concurrent_cases (or has no limit set)"""
+        return not ClinicianAvailability.objects.filter(
+            clinician=clinician,
+            current_active_cases__gte=F('max_concurrent_cases')
+        ).exists()
+    
+    def _reserve_capacity(self, clinician: User, availability: ClinicianAvailability = None) -> bool:
+        """
+        Count one more active case against the clinician, in a single UPDATE
+        that only matches while they are below max_concurrent_cases.
+        Clinicians with no availability record have no limit to enforce.
+        """
+        workload = ClinicianAvailability.objects.filter(clinician=clinician)
+        if availability is not None:
+            workload = ClinicianAvailability.objects.filter(pk=availability.pk)
         
-        # Update session
-        session = escalation.session
-        session.state = 'COMPLETED'
-        session.save()
-        
-        # Update clinician workload
-        if escalation.assigned_to:
-            try:
-                availability = ClinicianAvailability.objects.get(clinician=escalation.assigned_to)
-                availability.current_active_cases = max(0, availability.current_active_cases - 1)
-                availability.save()
-            except ClinicianAvailability.DoesNotExist:
-                pass
+        reserved = workload.filter(
+            current_active_cases__lt=F('max_concurrent_cases')
+        ).update(current_active_cases=F('current_active_cases') + 1)
+        return bool(reserved) or not workload.exists()
+    
+    def resolve_escalation(self, escalation: EscalationQueue) -> bool:
+        """
+        Mark escalation as resolved and update clinician workload. Only the
+        first resolve of a case matches the UPDATE, so a repeated or
+        concurrent one changes nothing and returns False.
+        """
+        
+        now = timezone.now()
+        with transaction.atomic():
+            resolved = EscalationQueue.objects.filter(
+                pk=escalation.pk, is_resolved=False
+            ).update(is_resolved=True, resolved_at=now)
+            if not resolved:
+                return False
+            
+            # Update session
+            PatientSession.objects.filter(pk=escalation.session_id).update(
+                state='COMPLETED', updated_at=now
+            )
+            
+            # Update clinician workload (never below zero); matched through
+            # the stored assignee, which a stale `escalation` may not have
+            ClinicianAvailability.objects.filter(
+                clinician__escalation_queue=escalation.pk,
+                current_active_cases__gt=0
+            ).update(current_active_cases=F('current_active_cases') - 1)
+        
+        escalation.is_resolved = True
+        escalation.resolved_at = now
+        if EscalationQueue.session.is_cached(escalation):
+            escalation.session.state = 'COMPLETED'
+        return True
     
     def get_pending_escalations(self):
         """Get all pending escalations ordered by priority"""
         return EscalationQueue.objects.filter(
             is_resolved=False,
             assigned_to__isnull=True
-        ).select_related('session').order_by('-priority', 'created_at')
+        ).select_related('session').order_by('-priority_rank', 'created_at')
     
     def get_clinician_queue(self, clinician: User):
         """Get all cases assigned to a specific clinician"""
         return EscalationQueue.objects.filter(
             assigned_to=clinician,
             is_resolved=False
-        ).select_related('session').order_by('-priority', 'assigned_at')
+        ).select_related('session').order_by('-priority_rank', 'assigned_at')
     
     def _notify_clinician(self, clinician: User, escalation: EscalationQueue):
         """Send notification to clinician (implement based on your notification system)"""
@@ -174,7 +255,7 @@ class ClinicianEscalation:
         }
         
         # TODO: Implement actual notification system
-        print(f"Notification sent to {clinician.username}: New case escalation")
+        logger.debug("Notification sent to %s: New case escalation", clinician.username)
         
         return notification_data
     
@@ -183,17 +264,21 @@ class ClinicianEscalation:
         
         session = escalation.session
         
-        # Get conversation history
-        messages = session.messages.all().order_by('created_at')
+        # Get conversation history (plain rows; only the columns we render)
+        messages = (
+            session.messages.order_by('created_at')
+            .values('content', 'is_from_user', 'created_at')
+            .iterator(chunk_size=200)
+        )
         
-        conversation_summary = []
-        for msg in messages:
-            sender = "Patient" if msg.is_from_user else "AI Assistant"
-            conversation_summary.append({
-                'sender': sender,
-                'message': msg.content,
-                'timestamp': msg.created_at.isoformat()
-            })
+        conversation_summary = [
+            {
+                'sender': "Patient" if msg['is_from_user'] else "AI Assistant",
+                'message': msg['content'],
+                'timestamp': msg['created_at'].isoformat()
+            }
+            for msg in messages
+        ]
         
         return {
             'patient_info': {
@@ -218,6 +303,12 @@ class ClinicianEscalation:
         }
 
 
+@lru_cache(maxsize=1)
+def get_escalation_manager() -> ClinicianEscalation:
+    """Shared ClinicianEscalation; it keeps no per-request state"""
+    return ClinicianEscalation()
+
+
 class ClinicianMessaging:
     """Handles messaging between clinicians and patients"""
     
@@ -225,7 +316,7 @@ class ClinicianMessaging:
     def send_clinician_message(session: PatientSession, clinician: User, message: str):
         """Send a message from clinician to patient"""
         from .models import MessageLog
-        from .whatsapp_handler import WhatsAppHandler
+        from .whatsapp_handler import get_handler
         
         # Log the message
         MessageLog.objects.create(
@@ -237,8 +328,7 @@ class ClinicianMessaging:
         )
         
         # Send via WhatsApp
-        whatsapp = WhatsAppHandler()
-        whatsapp.send_message(session.phone_number, message)
+        get_handler().queue_message(session.phone_number, message)
     
     @staticmethod
     def get_active_clinician_sessions(clinician: User):
@@ -0,0 +1,34 @@
+# whatsapp/keywords.py
+# Escalation keywords, kept free of model imports so models.py can use them
+import re
+
+URGENT_KEYWORDS = [
+    'chest pain', 'can\'t breathe', 'difficulty breathing',
+    'severe pain', 'bleeding heavily', 'unconscious',
+    'seizure', 'stroke', 'heart attack', 'suicide'
+]
+
+HIGH_PRIORITY_KEYWORDS = [
+    'severe', 'intense', 'unbearable', 'emergency',
+    'very bad', 'getting worse', 'spreading'
+]
+
+# One alternation over every keyword, so text is scanned once rather than
+# once per keyword. Longest first, so 'severe pain' wins over 'severe'.
+KEYWORD_PRIORITY = {
+    **{keyword: 'HIGH' for keyword in HIGH_PRIORITY_KEYWORDS},
+    **{keyword: 'URGENT' for keyword in URGENT_KEYWORDS},
+}
+KEYWORD_PATTERN = re.compile('|'.join(
+    re.escape(keyword) for keyword in sorted(KEYWORD_PRIORITY, key=len, reverse=True)
+))
+
+
+def keyword_priority(text: str):
+    """'URGENT' or 'HIGH' for the most serious keyword in (lowercased) text, else None"""
+    priority = None
+    for match in KEYWORD_PATTERN.finditer(text):
+        if KEYWORD_PRIORITY[match.group()] == 'URGENT':
+            return 'URGENT'
+        priority = 'HIGH'
+    return priority
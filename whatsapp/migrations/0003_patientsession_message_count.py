@@ -0,0 +1,35 @@
+# Generated by Django 5.2.7 on 2026-10-14 18:03
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_message_counts(apps, schema_editor):
+    PatientSession = apps.get_model('whatsapp', 'PatientSession')
+    MessageLog = apps.get_model('whatsapp', 'MessageLog')
+
+    counts = (
+        MessageLog.objects.filter(session=OuterRef('pk'))
+        .order_by()
+        .values('session')
+        .annotate(total=Count('pk'))
+        .values('total')
+    )
+    PatientSession.objects.update(message_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whatsapp', '0002_index_last_message_at_and_created_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patientsession',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_message_counts, migrations.RunPython.noop),
+    ]
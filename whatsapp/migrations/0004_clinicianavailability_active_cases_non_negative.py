@@ -0,0 +1,19 @@
+# Generated by Django 5.2.7 on 2026-10-14 18:14
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whatsapp', '0003_patientsession_message_count'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='clinicianavailability',
+            constraint=models.CheckConstraint(condition=models.Q(('current_active_cases__gte', 0)), name='clinician_active_cases_non_negative'),
+        ),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 5.2.7 on 2026-10-14 18:18
+
+import re
+
+from django.db import migrations, models
+
+# Frozen copy of the keyword tables as they were when this migration was
+# written; the live ones (whatsapp/keywords.py) may change later
+URGENT_KEYWORDS = [
+    'chest pain', 'can\'t breathe', 'difficulty breathing',
+    'severe pain', 'bleeding heavily', 'unconscious',
+    'seizure', 'stroke', 'heart attack', 'suicide'
+]
+HIGH_PRIORITY_KEYWORDS = [
+    'severe', 'intense', 'unbearable', 'emergency',
+    'very bad', 'getting worse', 'spreading'
+]
+KEYWORD_PRIORITY = {
+    **{keyword: 'HIGH' for keyword in HIGH_PRIORITY_KEYWORDS},
+    **{keyword: 'URGENT' for keyword in URGENT_KEYWORDS},
+}
+KEYWORD_PATTERN = re.compile('|'.join(
+    re.escape(keyword) for keyword in sorted(KEYWORD_PRIORITY, key=len, reverse=True)
+))
+
+
+def keyword_priority(text):
+    priority = None
+    for match in KEYWORD_PATTERN.finditer(text):
+        if KEYWORD_PRIORITY[match.group()] == 'URGENT':
+            return 'URGENT'
+        priority = 'HIGH'
+    return priority
+
+
+def backfill_keyword_priority(apps, schema_editor):
+    PatientSession = apps.get_model('whatsapp', 'PatientSession')
+    MessageLog = apps.get_model('whatsapp', 'MessageLog')
+
+    found = {}
+    contents = (
+        MessageLog.objects.filter(is_from_user=True)
+        .values_list('session_id', 'content')
+        .iterator(chunk_size=500)
+    )
+    for session_id, content in contents:
+        if found.get(session_id) == 'URGENT':
+            continue
+        priority = keyword_priority(content.lower())
+        if priority:
+            found[session_id] = 'URGENT' if priority == 'URGENT' else found.get(session_id, priority)
+
+    for priority in ('URGENT', 'HIGH'):
+        session_ids = [pk for pk, value in found.items() if value == priority]
+        PatientSession.objects.filter(pk__in=session_ids).update(keyword_priority=priority)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whatsapp', '0004_clinicianavailability_active_cases_non_negative'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patientsession',
+            name='keyword_priority',
+            field=models.CharField(blank=True, max_length=10, null=True),
+        ),
+        migrations.RunPython(backfill_keyword_priority, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.7 on 2026-10-14 18:24
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whatsapp', '0005_patientsession_keyword_priority'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='patientsession',
+            index=models.Index(condition=models.Q(('state', 'COMPLETED'), _negated=True), fields=['state'], name='ps_active_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patientsession',
+            index=models.Index(condition=models.Q(('escalated_to_clinician', True)), fields=['-last_message_at'], name='ps_escalated_recent_idx'),
+        ),
+    ]
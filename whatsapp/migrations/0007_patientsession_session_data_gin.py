@@ -0,0 +1,34 @@
+from django.db import migrations
+
+# GIN (jsonb_path_ops) index for session_data @> containment lookups. Only
+# PostgreSQL has it, and Meta.indexes can't be vendor-specific, so it lives
+# here as raw SQL and is a no-op on SQLite. CONCURRENTLY avoids locking the
+# table against writes, which requires a non-atomic migration.
+
+
+def create_gin_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS ps_sd_gin '
+        'ON whatsapp_patientsession USING gin (session_data jsonb_path_ops)'
+    )
+
+
+def drop_gin_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX CONCURRENTLY IF EXISTS ps_sd_gin')
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('whatsapp', '0006_patientsession_partial_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_gin_index, drop_gin_index),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.7 on 2026-10-14 18:25
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_priority_rank(apps, schema_editor):
+    EscalationQueue = apps.get_model('whatsapp', 'EscalationQueue')
+    ranks = {'LOW': 1, 'MEDIUM': 2, 'HIGH': 3, 'URGENT': 4}
+    for priority, rank in ranks.items():
+        EscalationQueue.objects.filter(priority=priority).update(priority_rank=rank)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whatsapp', '0007_patientsession_session_data_gin'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='escalationqueue',
+            options={'ordering': ['-priority_rank', 'created_at']},
+        ),
+        migrations.AddField(
+            model_name='escalationqueue',
+            name='priority_rank',
+            field=models.SmallIntegerField(default=2, editable=False),
+        ),
+        migrations.RunPython(backfill_priority_rank, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='escalationqueue',
+            index=models.Index(condition=models.Q(('is_resolved', False)), fields=['-priority_rank', 'created_at'], name='esc_queue_open_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.7 on 2026-10-14 18:27
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def raise_capacity_to_current_load(apps, schema_editor):
+    # Clinicians already over their limit would make AddConstraint fail;
+    # raise their limit to the load they actually carry
+    ClinicianAvailability = apps.get_model('whatsapp', 'ClinicianAvailability')
+    ClinicianAvailability.objects.filter(
+        current_active_cases__gt=models.F('max_concurrent_cases')
+    ).update(max_concurrent_cases=models.F('current_active_cases'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whatsapp', '0008_escalationqueue_priority_rank'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='clinicianavailability',
+            index=models.Index(condition=models.Q(('is_available', True)), fields=['current_active_cases'], name='ca_available_load_idx'),
+        ),
+        migrations.RunPython(raise_capacity_to_current_load, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='clinicianavailability',
+            constraint=models.CheckConstraint(condition=models.Q(('current_active_cases__lte', models.F('max_concurrent_cases'))), name='clinician_active_cases_within_capacity'),
+        ),
+    ]
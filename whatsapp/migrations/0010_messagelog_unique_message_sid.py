@@ -0,0 +1,19 @@
+# Generated by Django 5.2.7 on 2026-10-14 18:31
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whatsapp', '0009_clinicianavailability_capacity'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='messagelog',
+            constraint=models.UniqueConstraint(condition=models.Q(('message_sid__isnull', False), models.Q(('message_sid', ''), _negated=True)), fields=('message_sid',), name='messagelog_unique_message_sid'),
+        ),
+    ]
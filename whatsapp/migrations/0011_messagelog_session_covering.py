@@ -0,0 +1,36 @@
+from django.db import migrations
+
+# Covering (session, created_at) index carrying the message flags, so
+# PostgreSQL can answer per-session scans that don't need the body from the
+# index alone. Kept out of Meta.indexes because SQLite has no INCLUDE.
+# `content` is left out on purpose: a long message would exceed the btree
+# row size limit and fail the INSERT.
+
+
+def create_covering_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS msglog_session_covering '
+        'ON whatsapp_messagelog (session_id, created_at) '
+        'INCLUDE (is_from_user, is_from_clinician, clinician_id, media_url)'
+    )
+
+
+def drop_covering_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX CONCURRENTLY IF EXISTS msglog_session_covering')
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('whatsapp', '0010_messagelog_unique_message_sid'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_covering_index, drop_covering_index),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.7 on 2026-10-14 18:47
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whatsapp', '0011_messagelog_session_covering'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='escalationqueue',
+            index=models.Index(condition=models.Q(('is_resolved', False)), fields=['assigned_to', '-priority_rank', 'assigned_at'], name='esc_queue_open_assignee_idx'),
+        ),
+    ]
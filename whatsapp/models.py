@@ -1,10 +1,29 @@
 # whatsapp/models.py
 
 from django.db import models
+from django.db.models.functions import Concat, Trim
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
 from django.utils import timezone
 import json
 
+from .keywords import keyword_priority
+
+
+def full_name(user_field):
+    """
+    SQL equivalent of User.get_full_name() for the user behind `user_field`,
+    NULL when there is no user
+    """
+    return models.Case(
+        models.When(**{f'{user_field}__isnull': True}, then=models.Value(None)),
+        default=Trim(Concat(
+            f'{user_field}__first_name', models.Value(' '), f'{user_field}__last_name'
+        )),
+        output_field=models.CharField(),
+    )
+
+
 class PatientSession(models.Model):
     """Tracks a patient's conversation session"""
     
@@ -45,21 +64,39 @@ class PatientSession(models.Model):
     )
     escalation_reason = models.TextField(null=True, blank=True)
     
+    # Denormalized len(messages), kept current by MessageLog.save()
+    message_count = models.PositiveIntegerField(default=0)
+    # Most serious escalation keyword (URGENT/HIGH) the patient has typed so
+    # far, also kept current by MessageLog.save()
+    keyword_priority = models.CharField(max_length=10, null=True, blank=True)
+    
     # Timestamps
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
-    last_message_at = models.DateTimeField(default=timezone.now)
+    last_message_at = models.DateTimeField(default=timezone.now, db_index=True)
     
     class Meta:
         ordering = ['-last_message_at']
         indexes = [
             models.Index(fields=['phone_number', 'state']),
             models.Index(fields=['escalated_to_clinician', 'assigned_clinician']),
+            # Partial indexes: only the rows the hot queries actually look at
+            models.Index(
+                fields=['state'], name='ps_active_state_idx',
+                condition=~models.Q(state='COMPLETED')
+            ),
+            models.Index(
+                fields=['-last_message_at'], name='ps_escalated_recent_idx',
+                condition=models.Q(escalated_to_clinician=True)
+            ),
         ]
     
     def __str__(self):
         return f"{self.phone_number} - {self.state}"
     
+    # Memo for get_message_history(); plain attribute, not a column
+    _message_history = None
+    
     def get_session_context(self):
         """Returns formatted context for AI"""
         return {
@@ -70,9 +107,21 @@ class PatientSession(models.Model):
             'medical_history': self.medical_history,
             'state': self.state,
             'session_data': self.session_data,
-            'message_history': list(self.messages.values('content', 'is_from_user', 'created_at'))
+            'message_history': self.get_message_history()
         }
     
+    def get_message_history(self):
+        """
+        Messages as plain dicts, loaded once per instance; MessageLog.save()
+        clears the memo when it adds a message to this same instance.
+        """
+        if self._message_history is None:
+            self._message_history = list(
+                self.messages.values('content', 'is_from_user', 'created_at')
+                .iterator(chunk_size=500)
+            )
+        return self._message_history
+    
     def update_session_data(self, key, value):
         """Safely update session data"""
         self.session_data[key] = value
@@ -100,18 +149,52 @@ class MessageLog(models.Model):
     message_sid = models.CharField(max_length=100, null=True, blank=True)
     media_url = models.URLField(null=True, blank=True)
     
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     
     class Meta:
         ordering = ['created_at']
         indexes = [
             models.Index(fields=['session', 'created_at']),
         ]
+        constraints = [
+            # Twilio retries a webhook it doesn't see acknowledged; the same
+            # inbound SID must only be logged (and answered) once
+            models.UniqueConstraint(
+                fields=['message_sid'], name='messagelog_unique_message_sid',
+                condition=models.Q(message_sid__isnull=False) & ~models.Q(message_sid='')
+            ),
+        ]
+    
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+        if adding:
+            if MessageLog.session.is_cached(self):
+                self.session._message_history = None
+            changes = {'message_count': models.F('message_count') + 1}
+            if self.is_from_user:
+                changes.update(self._keyword_priority_change())
+            PatientSession.objects.filter(pk=self.session_id).update(**changes)
+    
+    def _keyword_priority_change(self):
+        """Update kwargs raising session.keyword_priority for this message (never lowering it)"""
+        found = keyword_priority(self.content.lower())
+        if found == 'URGENT':
+            return {'keyword_priority': 'URGENT'}
+        if found == 'HIGH':
+            return {'keyword_priority': models.Case(
+                models.When(keyword_priority='URGENT', then=models.Value('URGENT')),
+                default=models.Value('HIGH'),
+            )}
+        return {}
     
     def __str__(self):
         sender = "User" if self.is_from_user else "System"
         if self.is_from_clinician:
             sender = f"Clinician ({self.clinician.username})"
+        # List views defer `content` and annotate a short `preview` instead
+        if 'content' in self.get_deferred_fields() and hasattr(self, 'preview'):
+            return f"{sender}: {self.preview[:50]}"
         return f"{sender}: {self.content[:50]}"
 
 
@@ -131,6 +214,35 @@ class ClinicianAvailability(models.Model):
     
     last_active = models.DateTimeField(auto_now=True)
     
+    class Meta:
+        constraints = [
+            models.CheckConstraint(
+                condition=models.Q(current_active_cases__gte=0),
+                name='clinician_active_cases_non_negative'
+            ),
+            models.CheckConstraint(
+                condition=models.Q(current_active_cases__lte=models.F('max_concurrent_cases')),
+                name='clinician_active_cases_within_capacity'
+            ),
+        ]
+        indexes = [
+            # Least-busy available clinician lookup in assign_to_available_clinician()
+            models.Index(
+                fields=['current_active_cases'], name='ca_available_load_idx',
+                condition=models.Q(is_available=True)
+            ),
+        ]
+    
+    def clean(self):
+        # Same rule as clinician_active_cases_within_capacity, reported on the
+        # field instead of as an IntegrityError from the database
+        if (self.current_active_cases is not None and self.max_concurrent_cases is not None
+                and self.current_active_cases > self.max_concurrent_cases):
+            raise ValidationError({'max_concurrent_cases': (
+                f"Can't be lower than the {self.current_active_cases} cases "
+                "this clinician currently has open."
+            )})
+    
     def can_accept_case(self):
         return self.is_available and self.current_active_cases < self.max_concurrent_cases
     
@@ -153,7 +265,12 @@ class EscalationQueue(models.Model):
         on_delete=models.CASCADE,
         related_name='escalation'
     )
+    # Sortable stand-in for `priority`; ordering by the string itself would
+    # put LOW above HIGH
+    PRIORITY_RANKS = {'LOW': 1, 'MEDIUM': 2, 'HIGH': 3, 'URGENT': 4}
+    
     priority = models.CharField(max_length=10, choices=PRIORITY_CHOICES, default='MEDIUM')
+    priority_rank = models.SmallIntegerField(default=2, editable=False)
     reason = models.TextField()
     ai_assessment = models.TextField()
     
@@ -171,7 +288,27 @@ class EscalationQueue(models.Model):
     resolved_at = models.DateTimeField(null=True, blank=True)
     
     class Meta:
-        ordering = ['-priority', 'created_at']
+        ordering = ['-priority_rank', 'created_at']
+        indexes = [
+            models.Index(
+                fields=['-priority_rank', 'created_at'], name='esc_queue_open_idx',
+                condition=models.Q(is_resolved=False)
+            ),
+            # Open cases by assignee: the unassigned-pending count (NULL) and
+            # get_clinician_queue(), in the latter's order
+            models.Index(
+                fields=['assigned_to', '-priority_rank', 'assigned_at'],
+                name='esc_queue_open_assignee_idx',
+                condition=models.Q(is_resolved=False)
+            ),
+        ]
+    
+    def save(self, *args, **kwargs):
+        self.priority_rank = self.PRIORITY_RANKS[self.priority]
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'priority' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'priority_rank'}
+        super().save(*args, **kwargs)
     
     def __str__(self):
         return f"Escalation for {self.session.phone_number} - {self.priority}"
\ No newline at end of file
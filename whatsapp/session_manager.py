@@ -1,12 +1,31 @@
 # whatsapp/session_manager.py
 
+from types import MappingProxyType
+
 from .models import PatientSession, MessageLog
+from django.db import IntegrityError, transaction
+from django.db.models import F
 from django.utils import timezone
 
+
+def _freeze(transitions):
+    """Read-only {state: frozenset of states} copy, safe to share across threads"""
+    return MappingProxyType({state: frozenset(states) for state, states in transitions.items()})
+
+
+def _previous_states(transitions):
+    """Invert a {state: next states} map into {state: states that may precede it}"""
+    previous = {}
+    for state, next_states in transitions.items():
+        for next_state in next_states:
+            previous.setdefault(next_state, set()).add(state)
+    return _freeze(previous)
+
+
 class SessionManager:
     """Manages patient session state and transitions"""
     
-    STATE_TRANSITIONS = {
+    STATE_TRANSITIONS = _freeze({
         'NEW_USER': ['COLLECTING_PROFILE'],
         'COLLECTING_PROFILE': ['COLLECTING_SYMPTOMS', 'CONNECT_TO_CLINICIAN'],
         'COLLECTING_SYMPTOMS': ['AI_FOLLOWUP_QUESTIONS', 'CONNECT_TO_CLINICIAN'],
@@ -15,7 +34,12 @@ class SessionManager:
         'AWAITING_CLINICIAN_DECISION': ['CONNECT_TO_CLINICIAN', 'COMPLETED'],
         'CONNECT_TO_CLINICIAN': ['CLINICIAN_CHAT_ACTIVE'],
         'CLINICIAN_CHAT_ACTIVE': ['COMPLETED'],
-    }
+    })
+    
+    PREVIOUS_STATES = _previous_states(STATE_TRANSITIONS)
+    
+    # Reachable from any state
+    EMERGENCY_STATES = frozenset({'CONNECT_TO_CLINICIAN', 'COMPLETED'})
     
     def __init__(self, phone_number):
         self.phone_number = phone_number
@@ -23,27 +47,55 @@ class SessionManager:
     
     def get_or_create_session(self):
         """Get existing session or create new one"""
+        now = timezone.now()
         session, created = PatientSession.objects.get_or_create(
             phone_number=self.phone_number,
-            defaults={'state': 'NEW_USER'}
+            defaults={'state': 'NEW_USER', 'last_message_at': now}
         )
         
+        # New rows were inserted with `now` already; existing ones get a
+        # single column UPDATE instead of going through Model.save()
         if not created:
-            session.last_message_at = timezone.now()
-            session.save(update_fields=['last_message_at'])
+            PatientSession.objects.filter(pk=session.pk).update(last_message_at=now)
+            session.last_message_at = now
         
         return session
     
     def log_message(self, content, is_from_user=True, is_from_clinician=False, clinician=None, message_sid=None):
-        """Log a message in the conversation"""
-        return MessageLog.objects.create(
-            session=self.session,
-            content=content,
-            is_from_user=is_from_user,
-            is_from_clinician=is_from_clinician,
-            clinician=clinician,
-            message_sid=message_sid
-        )
+        """
+        Log a message in the conversation.
+        Returns None if a message with this message_sid is already logged.
+        """
+        try:
+            with transaction.atomic():
+                return MessageLog.objects.create(
+                    session=self.session,
+                    content=content,
+                    is_from_user=is_from_user,
+                    is_from_clinician=is_from_clinician,
+                    clinician=clinician,
+                    message_sid=message_sid
+                )
+        except IntegrityError:
+            if not message_sid:
+                raise
+            return None
+    
+    def log_replies(self, contents):
+        """
+        Log the system's outgoing messages with a single INSERT.
+        bulk_create() skips MessageLog.save(), so message_count is bumped here.
+        """
+        logs = MessageLog.objects.bulk_create([
+            MessageLog(session=self.session, content=content, is_from_user=False)
+            for content in contents
+        ])
+        if logs:
+            self.session._message_history = None
+            PatientSession.objects.filter(pk=self.session.pk).update(
+                message_count=F('message_count') + len(logs)
+            )
+        return logs
     
     def get_current_state(self):
         """Get current session state"""
@@ -51,40 +103,45 @@ class SessionManager:
     
     def transition_to(self, new_state):
         """Safely transition to a new state"""
-        current_state = self.session.state
+        # The allowed-transition check runs in the UPDATE's WHERE clause, so a
+        # concurrent webhook that already moved the session can't be overwritten
+        sessions = PatientSession.objects.filter(pk=self.session.pk)
+        if new_state not in self.EMERGENCY_STATES:
+            sessions = sessions.filter(state__in=self.PREVIOUS_STATES.get(new_state, frozenset()))
         
-        if new_state in self.STATE_TRANSITIONS.get(current_state, []):
-            self.session.state = new_state
-            self.session.save(update_fields=['state', 'updated_at'])
-            return True
-        else:
-            # Allow some emergency transitions
-            if new_state in ['CONNECT_TO_CLINICIAN', 'COMPLETED']:
-                self.session.state = new_state
-                self.session.save(update_fields=['state', 'updated_at'])
-                return True
+        if not sessions.update(state=new_state, updated_at=timezone.now()):
             return False
+        self.session.state = new_state
+        return True
     
     def update_profile(self, **kwargs):
         """Update patient profile fields"""
-        for key, value in kwargs.items():
-            if hasattr(self.session, key):
-                setattr(self.session, key, value)
-        self.session.save()
+        # Only the given columns: a full save() would write this instance's
+        # possibly stale message_count/keyword_priority back
+        fields = [key for key in kwargs if hasattr(self.session, key)]
+        for key in fields:
+            setattr(self.session, key, kwargs[key])
+        self.session.save(update_fields=[*fields, 'updated_at'])
     
     def get_conversation_history(self, limit=None):
-        """Get message history"""
-        messages = self.session.messages.all()
+        """Get message history, oldest first (only the last `limit` messages if given)"""
+        # Plain rows with only the columns we return; no MessageLog instances
+        messages = self.session.messages.values(
+            'content', 'is_from_user', 'is_from_clinician', 'created_at'
+        )
         if limit:
-            messages = messages[:limit]
+            # LIMIT the newest rows in SQL, then put them back in order
+            rows = reversed(list(messages.order_by('-created_at')[:limit]))
+        else:
+            rows = messages.iterator(chunk_size=200)
         return [
             {
-                'content': msg.content,
-                'is_from_user': msg.is_from_user,
-                'is_from_clinician': msg.is_from_clinician,
-                'timestamp': msg.created_at.isoformat()
+                'content': msg['content'],
+                'is_from_user': msg['is_from_user'],
+                'is_from_clinician': msg['is_from_clinician'],
+                'timestamp': msg['created_at'].isoformat()
             }
-            for msg in messages
+            for msg in rows
         ]
     
     def store_data(self, key, value):
@@ -113,21 +170,23 @@ class SessionManager:
     
     def escalate_to_clinician(self, reason, ai_assessment=None):
         """Mark session for clinician escalation"""
-        from .clinician_escalation import ClinicianEscalation
+        from .clinician_escalation import get_escalation_manager
         
         self.session.escalated_to_clinician = True
         self.session.escalation_reason = reason
         if ai_assessment:
             self.session.ai_overview = ai_assessment
-        self.session.save()
+        self.session.save(update_fields=[
+            'escalated_to_clinician', 'escalation_reason', 'ai_overview', 'updated_at'
+        ])
         
         # Create escalation queue entry
-        escalation = ClinicianEscalation()
-        return escalation.create_escalation(self.session, reason, ai_assessment)
+        return get_escalation_manager().create_escalation(self.session, reason, ai_assessment)
     
     def get_full_context(self):
         """Get complete session context for AI or clinician"""
         return {
+            'session_id': self.session.pk,
             'phone_number': self.phone_number,
             'state': self.session.state,
             'profile': {
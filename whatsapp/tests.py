@@ -1,3 +1,696 @@
-from django.test import TestCase
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.test import RequestFactory, TestCase
+from django.urls import reverse
+from django.utils.datastructures import MultiValueDict
+from twilio.request_validator import RequestValidator
+
+from .ai_engine import AIEngineComplete, CircuitBreaker, _read_until_json_closes, _singleflight_key
+from .clinician_escalation import AssignResult, get_escalation_manager
+from .models import PatientSession, MessageLog, ClinicianAvailability, EscalationQueue
+from .session_manager import SessionManager
+from .whatsapp_handler import EMPTY_TWIML, WhatsAppHandler
+
+
+TWILIO_ENV = {
+    'TWILIO_ACCOUNT_SID': 'AC123', 'TWILIO_AUTH_TOKEN': 'secret', 'TWILIO_WHATSAPP_NUMBER': 'whatsapp:+15550009999'
+}
+
+
+def make_clinician(username, active=0, max_cases=5, available=True):
+    clinician = User.objects.create_user(username, first_name=username.title())
+    ClinicianAvailability.objects.create(
+        clinician=clinician, is_available=available,
+        current_active_cases=active, max_concurrent_cases=max_cases
+    )
+    return clinician
+
+
+def make_escalation(phone_number, priority='MEDIUM'):
+    session = PatientSession.objects.create(phone_number=phone_number, state='CONNECT_TO_CLINICIAN')
+    return EscalationQueue.objects.create(
+        session=session, priority=priority, reason='Needs review', ai_assessment='Overview'
+    )
+
+
+def active_cases(clinician):
+    return ClinicianAvailability.objects.values_list('current_active_cases', flat=True).get(clinician=clinician)
+
+
+def start_patch(test_case, patcher):
+    mocked = patcher.start()
+    test_case.addCleanup(patcher.stop)
+    return mocked
+
+
+class MessageCountTests(TestCase):
+    """PatientSession.message_count is kept current with F() UPDATEs"""
+
+    def setUp(self):
+        self.session_mgr = SessionManager('+15550000001')
+        self.session = self.session_mgr.session
+
+    def message_count(self):
+        return PatientSession.objects.values_list('message_count', flat=True).get(pk=self.session.pk)
+
+    def test_create_bumps_count_in_one_update(self):
+        # INSERT of the message plus the UPDATE of the counter
+        with self.assertNumQueries(2):
+            MessageLog.objects.create(session=self.session, content='hello')
+        self.assertEqual(self.message_count(), 1)
+
+    def test_log_replies_bumps_count_once_for_all_rows(self):
+        # One bulk INSERT and one UPDATE, however many replies
+        with self.assertNumQueries(2):
+            self.session_mgr.log_replies(['one', 'two', 'three'])
+        self.assertEqual(self.message_count(), 3)
+        self.assertEqual(self.session.messages.count(), 3)
+
+    def test_log_replies_with_nothing_to_log(self):
+        with self.assertNumQueries(0):
+            self.session_mgr.log_replies([])
+        self.assertEqual(self.message_count(), 0)
+
+    def test_profile_update_keeps_count_from_stale_instance(self):
+        # self.session was loaded before these messages were logged
+        self.session_mgr.log_message('hi')
+        self.session_mgr.log_replies(['Welcome'])
+        self.session_mgr.update_profile(age=30)
+
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.message_count, 2)
+        self.assertEqual(self.session.age, 30)
+
+    def test_escalation_keeps_count_from_stale_instance(self):
+        self.session_mgr.log_message('hi')
+        self.session_mgr.escalate_to_clinician('Needs review', 'Overview')
+
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.message_count, 1)
+        self.assertTrue(self.session.escalated_to_clinician)
+
+    def test_full_save_can_correct_count(self):
+        self.session_mgr.log_message('hi')
+        self.session.message_count = 0
+        self.session.save()
+        self.assertEqual(self.message_count(), 0)
+
+
+class ClinicianCapacityTests(TestCase):
+    """Clinicians at max_concurrent_cases are refused new cases"""
+
+    def setUp(self):
+        self.clinician = make_clinician('full', active=2, max_cases=2)
+        self.escalation = make_escalation('+15550000002')
+
+    def test_assign_at_capacity_is_refused(self):
+        result = get_escalation_manager().assign_to_clinician(self.escalation, self.clinician)
+
+        self.assertIs(result, AssignResult.AT_CAPACITY)
+        self.assertEqual(active_cases(self.clinician), 2)
+        self.escalation.refresh_from_db()
+        self.assertIsNone(self.escalation.assigned_to)
+
+    def test_assign_below_capacity_takes_a_slot(self):
+        clinician = make_clinician('spare', active=1, max_cases=2)
+
+        result = get_escalation_manager().assign_to_clinician(self.escalation, clinician)
+
+        self.assertIs(result, AssignResult.ASSIGNED)
+        self.assertEqual(active_cases(clinician), 2)
+        self.escalation.refresh_from_db()
+        self.assertEqual(self.escalation.assigned_to, clinician)
+        self.assertEqual(self.escalation.session.state, 'CLINICIAN_CHAT_ACTIVE')
+
+    def test_auto_assignment_skips_full_clinicians(self):
+        self.assertFalse(get_escalation_manager().assign_to_available_clinician(self.escalation))
+
+        clinician = make_clinician('spare', active=4, max_cases=5)
+        self.assertTrue(get_escalation_manager().assign_to_available_clinician(self.escalation))
+        self.escalation.refresh_from_db()
+        self.assertEqual(self.escalation.assigned_to, clinician)
+
+    def test_accept_case_at_capacity_returns_409(self):
+        self.client.force_login(self.clinician)
+
+        response = self.client.post(reverse('accept_case', args=[self.escalation.pk]))
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json(), {'error': 'At capacity'})
+        self.assertEqual(active_cases(self.clinician), 2)
+
+    def test_lowering_max_below_open_cases_is_a_validation_error(self):
+        availability = self.clinician.availability
+        availability.max_concurrent_cases = 1
+
+        with self.assertRaises(ValidationError) as raised:
+            availability.full_clean()
+        self.assertIn('max_concurrent_cases', raised.exception.message_dict)
+
+
+class QueuePickupTests(TestCase):
+    """assign_next_pending() hands out the queue head, most urgent first"""
+
+    def setUp(self):
+        self.clinician = make_clinician('picker', max_cases=2)
+
+    def test_picks_most_urgent_then_oldest(self):
+        older = make_escalation('+15550000003', 'MEDIUM')
+        make_escalation('+15550000004', 'LOW')
+        urgent = make_escalation('+15550000005', 'URGENT')
+        manager = get_escalation_manager()
+
+        self.assertEqual(manager.assign_next_pending(self.clinician), (AssignResult.ASSIGNED, urgent))
+        self.assertEqual(manager.assign_next_pending(self.clinician), (AssignResult.ASSIGNED, older))
+        self.assertEqual(active_cases(self.clinician), 2)
+
+    def test_assigned_and_resolved_cases_are_not_pending(self):
+        assigned = make_escalation('+15550000003')
+        get_escalation_manager().assign_to_clinician(assigned, make_clinician('other'))
+        EscalationQueue.objects.filter(pk=make_escalation('+15550000004').pk).update(is_resolved=True)
+
+        self.assertEqual(
+            get_escalation_manager().assign_next_pending(self.clinician),
+            (AssignResult.NONE_PENDING, None)
+        )
+
+    def test_at_capacity_is_checked_before_touching_the_queue(self):
+        escalation = make_escalation('+15550000003')
+        ClinicianAvailability.objects.filter(clinician=self.clinician).update(current_active_cases=2)
+
+        # Just the capacity lookup; no row is selected for update
+        with self.assertNumQueries(1):
+            result = get_escalation_manager().assign_next_pending(self.clinician)
+
+        self.assertEqual(result, (AssignResult.AT_CAPACITY, None))
+        escalation.refresh_from_db()
+        self.assertIsNone(escalation.assigned_to)
+
+    @mock.patch('whatsapp.views.get_handler')
+    def test_accept_next_case_view(self, get_handler):
+        self.client.force_login(self.clinician)
+        url = reverse('accept_next_case')
+
+        self.assertEqual(self.client.post(url).status_code, 404)
+
+        escalation = make_escalation('+15550000003')
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'status': 'Case accepted', 'case_id': escalation.pk})
+        get_handler.return_value.queue_message.assert_called_once()
+
+        make_escalation('+15550000004')
+        make_escalation('+15550000005')
+        self.client.post(url)
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json(), {'error': 'At capacity'})
+
+
+class WebhookRetryTests(TestCase):
+    """A webhook Twilio retries with the same MessageSid is logged and answered once"""
+
+    def setUp(self):
+        patcher = mock.patch('whatsapp.views.get_ai_engine')
+        self.engine = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.engine.check_for_clinician_request.return_value = False
+        self.engine.agenerate_response = mock.AsyncMock(return_value={
+            'response': 'How old are you?', 'next_state': 'COLLECTING_PROFILE'
+        })
+
+    def post(self, message_sid):
+        return self.client.post(reverse('whatsapp-webhook'), {
+            'From': 'whatsapp:+15550000010', 'Body': 'Hello', 'MessageSid': message_sid,
+        })
+
+    def test_repeated_post_gets_empty_twiml(self):
+        first = self.post('SM123')
+        self.assertEqual(first.status_code, 200)
+        self.assertIn('How old are you?', first.content.decode())
+
+        retry = self.post('SM123')
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.content.decode(), EMPTY_TWIML)
+
+        self.engine.agenerate_response.assert_awaited_once()
+        self.assertEqual(MessageLog.objects.filter(message_sid='SM123').count(), 1)
+        session = PatientSession.objects.get(phone_number='+15550000010')
+        self.assertEqual(session.message_count, 2)  # the message and its one reply
+
+    def test_new_sid_is_answered(self):
+        self.post('SM123')
+        self.post('SM124')
+        self.assertEqual(self.engine.agenerate_response.await_count, 2)
+
+    def test_log_message_returns_none_for_a_logged_sid(self):
+        session_mgr = SessionManager('+15550000010')
+        self.assertIsNotNone(session_mgr.log_message('Hello', message_sid='SM123'))
+        self.assertIsNone(session_mgr.log_message('Hello', message_sid='SM123'))
+
+    def test_messages_without_sid_are_not_deduplicated(self):
+        session_mgr = SessionManager('+15550000010')
+        session_mgr.log_message('one', is_from_user=False)
+        session_mgr.log_message('two', is_from_user=False, message_sid='')
+        self.assertEqual(session_mgr.session.messages.count(), 2)
+
+
+class ConditionalClaimTests(TestCase):
+    """Cases are claimed and resolved with UPDATEs that match only once"""
+
+    def setUp(self):
+        self.first = make_clinician('first')
+        self.second = make_clinician('second')
+        self.escalation = make_escalation('+15550000020')
+        self.manager = get_escalation_manager()
+
+    def test_second_claim_is_taken_and_frees_its_slot(self):
+        # A stale copy, loaded before the first clinician claimed the case
+        stale = EscalationQueue.objects.get(pk=self.escalation.pk)
+
+        self.assertIs(self.manager.assign_to_clinician(self.escalation, self.first), AssignResult.ASSIGNED)
+        self.assertIs(self.manager.assign_to_clinician(stale, self.second), AssignResult.TAKEN)
+
+        self.escalation.refresh_from_db()
+        self.assertEqual(self.escalation.assigned_to, self.first)
+        self.assertEqual(active_cases(self.first), 1)
+        self.assertEqual(active_cases(self.second), 0)
+
+    def test_double_resolve_decrements_workload_once(self):
+        self.manager.assign_to_clinician(self.escalation, self.first)
+        stale = EscalationQueue.objects.get(pk=self.escalation.pk)
+
+        self.assertTrue(self.manager.resolve_escalation(self.escalation))
+        self.assertFalse(self.manager.resolve_escalation(stale))
+
+        self.assertEqual(active_cases(self.first), 0)
+        self.escalation.refresh_from_db()
+        self.assertTrue(self.escalation.is_resolved)
+        self.assertEqual(self.escalation.session.state, 'COMPLETED')
+
+    def test_resolve_goes_by_the_stored_assignee(self):
+        # Loaded before assignment, so it doesn't know who holds the case
+        stale = EscalationQueue.objects.get(pk=self.escalation.pk)
+        self.manager.assign_to_clinician(self.escalation, self.first)
+
+        self.assertTrue(self.manager.resolve_escalation(stale))
+        self.assertEqual(active_cases(self.first), 0)
+
+    @mock.patch('whatsapp.views.get_handler')
+    def test_resolve_case_view_twice(self, get_handler):
+        self.manager.assign_to_clinician(self.escalation, self.first)
+        self.client.force_login(self.first)
+        url = reverse('resolve_case', args=[self.escalation.pk])
+
+        self.assertEqual(self.client.post(url).status_code, 200)
+        response = self.client.post(url)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'Case already resolved'})
+        get_handler.return_value.queue_message.assert_called_once()
+        self.assertEqual(active_cases(self.first), 0)
+
+
+class AnswerCacheTests(TestCase):
+    """First triage answers are shared only between identical symptom prompts"""
+
+    REPLY = '{"question": "How long have you had it?", "should_escalate": false}'
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        start_patch(self, mock.patch('whatsapp.ai_engine._get_groq_client'))
+        start_patch(self, mock.patch.object(AIEngineComplete, '_prefetch_followup'))
+        self.api = start_patch(self, mock.patch.object(AIEngineComplete, '_call_openai_api', return_value={
+            'success': True, 'text': self.REPLY
+        }))
+        self.engine = AIEngineComplete()
+
+    def ask(self, message, **profile):
+        return self.engine._handle_symptom_collection({'profile': profile}, message)
+
+    def test_same_profile_and_complaint_share_an_answer(self):
+        self.ask('Headache since Monday', age=34, gender='Female')
+        result = self.ask('headache since monday!', age=34, gender='Female')
+
+        self.assertEqual(self.api.call_count, 1)
+        self.assertEqual(result['response'], 'How long have you had it?')
+
+    def test_profiles_differing_only_in_age_do_not_share(self):
+        self.ask('Headache', age=34, gender='Female')
+        self.ask('Headache', age=35, gender='Female')
+
+        self.assertEqual(self.api.call_count, 2)
+        self.assertNotEqual(
+            self.engine._answer_cache_key({'age': 34, 'gender': 'Female'}, 'Headache'),
+            self.engine._answer_cache_key({'age': 35, 'gender': 'Female'}, 'Headache'),
+        )
+
+
+class StreamedJsonTests(TestCase):
+    """Streamed replies are cut where the first JSON object closes"""
+
+    def setUp(self):
+        start_patch(self, mock.patch('whatsapp.ai_engine._get_groq_client'))
+        self.engine = AIEngineComplete()
+
+    def test_prose_before_the_object_is_not_counted(self):
+        pieces = ['Sure [see below]: want it ', 'quoted "as is"? ', '{"question": "Any fever?",',
+                  ' "options": ["yes", "no"]}', ' Hope that helps!']
+
+        text = _read_until_json_closes(iter(pieces))
+
+        self.assertTrue(text.endswith('"no"]}'))
+        self.assertEqual(self.engine._parse_json_response(text), {
+            'question': 'Any fever?', 'options': ['yes', 'no']
+        })
+
+    def test_brackets_inside_strings_are_ignored(self):
+        pieces = ['{"question": "Is it {sharp', '} or [dull]? Say \\"}\\"",', ' "should_escalate": false}', '{}']
+
+        text = _read_until_json_closes(iter(pieces))
+
+        self.assertEqual(text, '{"question": "Is it {sharp} or [dull]? Say \\"}\\"", "should_escalate": false}')
+
+    def test_unclosed_stream_is_returned_whole(self):
+        self.assertEqual(_read_until_json_closes(iter(['Here: ', '{"question": "Any'])), 'Here: {"question": "Any')
+
+
+class CircuitBreakerTests(TestCase):
+    """The Groq breaker opens on repeated failures and probes once per cooldown"""
+
+    def setUp(self):
+        self.now = 1000.0
+        clock = start_patch(self, mock.patch('whatsapp.ai_engine.time'))
+        clock.monotonic.side_effect = lambda: self.now
+        self.breaker = CircuitBreaker(threshold=3, cooldown=30)
+
+    def open_breaker(self):
+        for _ in range(3):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.record_failure()
+
+    def test_opens_at_the_threshold(self):
+        for _ in range(2):
+            self.breaker.record_failure()
+        self.assertTrue(self.breaker.closed())
+        self.assertTrue(self.breaker.allow())
+
+        self.breaker.record_failure()
+        self.assertFalse(self.breaker.closed())
+        self.assertFalse(self.breaker.allow())
+
+    def test_success_resets_the_failure_count(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.closed())
+
+    def test_rejects_while_open(self):
+        self.open_breaker()
+        self.now += 29
+        self.assertFalse(self.breaker.allow())
+
+    def test_lets_one_probe_through_after_the_cooldown(self):
+        self.open_breaker()
+        self.now += 30
+
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.assertFalse(self.breaker.closed())
+
+    def test_successful_probe_closes(self):
+        self.open_breaker()
+        self.now += 30
+        self.breaker.allow()
+
+        self.breaker.record_success()
+        self.assertTrue(self.breaker.closed())
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_probe_reopens_for_a_full_cooldown(self):
+        self.open_breaker()
+        self.now += 30
+        self.breaker.allow()
+
+        self.breaker.record_failure()
+        self.now += 29
+        self.assertFalse(self.breaker.allow())
+        self.now += 1
+        self.assertTrue(self.breaker.allow())
+
+    def test_released_probe_lets_the_next_one_through(self):
+        self.open_breaker()
+        self.now += 30
+        self.breaker.allow()
+
+        self.breaker.release()
+        self.assertTrue(self.breaker.allow())
+
+
+class SingleFlightTests(TestCase):
+    """Identical concurrent Groq calls share one request"""
+
+    CONVERSATION = [{'role': 'user', 'content': 'Headache'}]
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        start_patch(self, mock.patch('whatsapp.ai_engine._get_groq_client'))
+        start_patch(self, mock.patch('whatsapp.ai_engine.SINGLEFLIGHT_POLL_INTERVAL', 0.01))
+        self.request = start_patch(self, mock.patch.object(AIEngineComplete, '_request_completion'))
+        self.engine = AIEngineComplete()
+        self.leader_started = threading.Event()
+        self.finish_leader = threading.Event()
+
+    def call(self):
+        return self.engine._call_openai_api('prompt', self.CONVERSATION, user='patient')
+
+    def run_concurrently(self, count):
+        """Start one caller, wait until it is inside the request, then start the rest"""
+        results = [None] * count
+
+        def run(i):
+            results[i] = self.call()
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+        threads[0].start()
+        self.assertTrue(self.leader_started.wait(5))
+        for thread in threads[1:]:
+            thread.start()
+        self.finish_leader.set()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def slow_reply(self, *replies):
+        replies = iter(replies)
+
+        def request(*args):
+            reply = next(replies)
+            if not self.leader_started.is_set():
+                self.leader_started.set()
+                self.finish_leader.wait(5)
+            return reply
+        self.request.side_effect = request
+
+    def test_concurrent_identical_calls_hit_the_api_once(self):
+        self.slow_reply({'success': True, 'text': '{"question": "Since when?"}'})
+
+        results = self.run_concurrently(4)
+
+        self.request.assert_called_once()
+        self.assertEqual([r['text'] for r in results], ['{"question": "Since when?"}'] * 4)
+
+    def test_waiter_makes_its_own_call_when_the_holder_fails(self):
+        self.slow_reply({'success': False, 'error': 'boom'}, {'success': True, 'text': '{}'})
+
+        leader, waiter = self.run_concurrently(2)
+
+        self.assertEqual(self.request.call_count, 2)
+        self.assertFalse(leader['success'])
+        self.assertEqual(waiter, {'success': True, 'text': '{}'})
+
+    def test_waiter_gives_up_on_a_stuck_holder(self):
+        # Another worker took the lock and never published a result
+        cache.add(f"{_singleflight_key('prompt', self.CONVERSATION, 1000, 'patient')}:lock", 1)
+        self.request.return_value = {'success': True, 'text': '{}'}
+
+        with mock.patch('whatsapp.ai_engine.SINGLEFLIGHT_WAIT', 0.05):
+            self.assertEqual(self.call(), {'success': True, 'text': '{}'})
+        self.request.assert_called_once()
+
+
+class MessageBatcherTests(TestCase):
+    """Queued replies are batched per recipient and sent through Twilio in order"""
+
+    def setUp(self):
+        start_patch(self, mock.patch.dict('os.environ', TWILIO_ENV))
+        self.create = start_patch(self, mock.patch('whatsapp.whatsapp_handler.Client')).return_value.messages.create
+        self.register = start_patch(self, mock.patch('whatsapp.whatsapp_handler.atexit.register'))
+        self.handler = WhatsAppHandler()
+        self.addCleanup(self.handler.batcher.flush_all, lambda *args: None)
+
+    def sent(self, count):
+        """Bodies sent, once `count` sends have been made"""
+        deadline = time.monotonic() + 5
+        while self.create.call_count < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return [(c.kwargs['to'], c.kwargs['body']) for c in self.create.call_args_list]
+
+    def test_messages_in_the_window_go_out_as_one(self):
+        self.handler.queue_message('+15550000030', 'Thanks.')
+        self.handler.queue_message('+15550000030', 'Any fever?', buttons=['Yes', 'No'])
+
+        self.assertEqual(self.sent(1), [('whatsapp:+15550000030', 'Thanks.\n\nAny fever?\n\n• Yes\n• No')])
+        self.assertEqual(self.create.call_args.kwargs['from_'], 'whatsapp:+15550009999')
+
+    def test_adjacent_duplicates_are_sent_once(self):
+        for message in ['Hello', 'Hello', 'Any fever?', 'Hello']:
+            self.handler.queue_message('+15550000030', message)
+
+        self.assertEqual(self.sent(1), [('whatsapp:+15550000030', 'Hello\n\nAny fever?\n\nHello')])
+
+    def test_each_recipient_gets_messages_in_order(self):
+        first_started, finish_first = threading.Event(), threading.Event()
+
+        def create(**params):
+            if params['body'] == 'first':
+                first_started.set()
+                finish_first.wait(5)
+            return mock.Mock(sid='SM1', status='queued')
+        self.create.side_effect = create
+
+        self.handler.queue_message('+15550000031', 'first')
+        self.handler.batcher.flush('+15550000031')
+        self.assertTrue(first_started.wait(5))
+        self.handler.queue_message('+15550000031', 'second')
+        self.handler.batcher.flush('+15550000031')
+        self.handler.queue_message('+15550000032', 'other')
+        self.handler.batcher.flush('+15550000032')
+
+        # Another recipient isn't held up by the slow send
+        self.assertEqual(self.sent(2)[1], ('whatsapp:+15550000032', 'other'))
+        finish_first.set()
+        self.assertEqual([body for to, body in self.sent(3) if to.endswith('31')], ['first', 'second'])
+
+    def test_atexit_sends_pending_messages_inline(self):
+        self.handler.batcher.timeout = 60
+        self.handler.queue_message('+15550000030', 'Goodbye')
+
+        flush_all, send = self.register.call_args.args
+        flush_all(send)
+
+        # Sent from this thread, without waiting on the batch timer or the pool
+        self.assertEqual(self.create.call_count, 1)
+        self.assertEqual(self.create.call_args.kwargs['body'], 'Goodbye')
+        self.assertEqual(self.handler.batcher._timers, {})
+
+
+class WebhookSignatureTests(TestCase):
+    """validate_webhook accepts only requests signed with the auth token"""
+
+    PARAMS = {'From': 'whatsapp:+15550000040', 'Body': 'Hello', 'MessageSid': 'SM1'}
+
+    def setUp(self):
+        start_patch(self, mock.patch.dict('os.environ', TWILIO_ENV))
+        start_patch(self, mock.patch('whatsapp.whatsapp_handler.Client'))
+        start_patch(self, mock.patch('whatsapp.whatsapp_handler.atexit.register'))
+        self.handler = WhatsAppHandler()
+        self.path = reverse('whatsapp-webhook')
+
+    def sign(self, url, params=PARAMS):
+        return RequestValidator(TWILIO_ENV['TWILIO_AUTH_TOKEN']).compute_signature(url, params)
+
+    def request(self, signature, params=PARAMS):
+        return RequestFactory().post(self.path, params, secure=True, HTTP_X_TWILIO_SIGNATURE=signature)
+
+    def test_valid_signature_passes_without_the_sdk_validator(self):
+        request = self.request(self.sign(f'https://testserver{self.path}'))
+
+        with mock.patch('whatsapp.whatsapp_handler.RequestValidator') as validator:
+            self.assertTrue(self.handler.validate_webhook(request))
+        validator.assert_not_called()
+
+    def test_repeated_parameters_match_the_sdk_signature(self):
+        params = MultiValueDict({name: [value] for name, value in self.PARAMS.items()})
+        params.setlist('MediaUrl0', ['https://b.example', 'https://a.example'])
+        request = self.request(self.sign(f'https://testserver{self.path}', params), dict(params.lists()))
+
+        with mock.patch('whatsapp.whatsapp_handler.RequestValidator') as validator:
+            self.assertTrue(self.handler.validate_webhook(request))
+        validator.assert_not_called()
+
+    def test_tampered_body_fails(self):
+        signature = self.sign(f'https://testserver{self.path}')
+
+        self.assertFalse(self.handler.validate_webhook(self.request(signature, {**self.PARAMS, 'Body': 'Hi'})))
+
+    def test_signature_for_another_url_fails(self):
+        signature = self.sign(f'https://testserver{self.path}?next=/admin/')
+
+        self.assertFalse(self.handler.validate_webhook(self.request(signature)))
+
+    def test_url_signed_with_explicit_port_falls_back_to_the_sdk(self):
+        request = self.request(self.sign(f'https://testserver:443{self.path}'))
+
+        with mock.patch('whatsapp.whatsapp_handler.RequestValidator', wraps=RequestValidator) as validator:
+            self.assertTrue(self.handler.validate_webhook(request))
+        validator.assert_called_once_with(TWILIO_ENV['TWILIO_AUTH_TOKEN'])
+
+    def test_no_auth_token_skips_validation(self):
+        self.handler.auth_token = None
+        self.assertTrue(self.handler.validate_webhook(self.request('')))
+
+
+class SessionHistoryTests(TestCase):
+    """session_history pages back from the newest messages"""
+
+    def setUp(self):
+        self.client.force_login(make_clinician('reader'))
+        self.session_mgr = SessionManager('+15550000050')
+        self.ids = [self.session_mgr.log_message(f'message {i}').pk for i in range(5)]
+        self.url = reverse('session_history', args=['+15550000050'])
+
+    def history(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        return [m['content'] for m in data['history']], data['next_before_id']
+
+    def test_default_is_the_newest_max_limit_messages(self):
+        with mock.patch('whatsapp.views.SESSION_HISTORY_MAX_LIMIT', 3):
+            self.assertEqual(self.history(), (['message 2', 'message 3', 'message 4'], self.ids[2]))
+            # limit is capped at the maximum too
+            self.assertEqual(self.history(limit=10)[0], ['message 2', 'message 3', 'message 4'])
+
+    def test_pages_back_with_before_id(self):
+        page, next_before_id = self.history(limit=2)
+        self.assertEqual((page, next_before_id), (['message 3', 'message 4'], self.ids[3]))
+
+        page, next_before_id = self.history(limit=2, before_id=next_before_id)
+        self.assertEqual((page, next_before_id), (['message 1', 'message 2'], self.ids[1]))
+
+        self.assertEqual(self.history(limit=2, before_id=next_before_id), (['message 0'], None))
+
+    def test_page_ending_on_the_first_message_has_no_next(self):
+        # Exactly `limit` messages left: no extra row, so no older page
+        self.assertEqual(self.history(limit=3, before_id=self.ids[3]), (['message 0', 'message 1', 'message 2'], None))
+        self.assertEqual(self.history(limit=5), ([f'message {i}' for i in range(5)], None))
+        self.assertEqual(self.history(limit=4)[1], self.ids[1])
+
+    def test_non_integer_paging_is_a_400(self):
+        for params in ({'limit': 'ten'}, {'before_id': '1.5'}):
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json(), {'error': 'limit and before_id must be integers'})
+
+    def test_unknown_session_is_a_404(self):
+        response = self.client.get(reverse('session_history', args=['+15550000059']))
+        self.assertEqual(response.status_code, 404)
@@ -1,7 +1,23 @@
 # whatsapp/utils.py
+import threading
+
 from twilio.rest import Client
 from django.conf import settings
 
+# One Twilio client per process, so its HTTP session (and connections) is reused
+_client = None
+_client_lock = threading.Lock()
+
+
+def _get_client(account_sid, auth_token):
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = Client(account_sid, auth_token)
+    return _client
+
+
 def send_whatsapp_message(to, body):
     """
     Send WhatsApp message using Twilio. 'to' must be like 'whatsapp:+234XXXXXXXXX'.
@@ -12,7 +28,7 @@ def send_whatsapp_message(to, body):
     from_number = getattr(settings, "TWILIO_WHATSAPP_NUMBER", None)
     if not (account_sid and auth_token and from_number):
         raise RuntimeError("Twilio credentials not configured in settings or .env.")
-    client = Client(account_sid, auth_token)
+    client = _get_client(account_sid, auth_token)
     msg = client.messages.create(
         body=body,
         from_=from_number,
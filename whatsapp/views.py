@@ -4,24 +4,72 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import get_object_or_404
+from django.core.cache import cache
+from django.db.models import F
+from asgiref.sync import sync_to_async
 
-from .whatsapp_handler import WhatsAppHandler, WhatsAppTemplates
+from .whatsapp_handler import WhatsAppTemplates, get_handler
 from .session_manager import SessionManager
-from .ai_engine import AIEngineComplete
-from .clinician_escalation import ClinicianEscalation, ClinicianMessaging
-from .models import PatientSession, EscalationQueue, MessageLog, ClinicianAvailability
+from .ai_engine import get_ai_engine
+from .clinician_escalation import AssignResult, ClinicianMessaging, get_escalation_manager
+from .models import PatientSession, EscalationQueue, MessageLog, ClinicianAvailability, full_name
 
+from datetime import datetime
 import json
+import logging
+
+try:
+    import orjson  # optional, much faster C parser/serializer
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# Columns the queue lists render, read as plain rows; skips the session's
+# profile/JSON blobs and the long ai_assessment text
+QUEUE_FIELDS = ['id', 'priority', 'reason', 'created_at', 'assigned_at']
+PENDING_QUEUE_FIELDS = ['id', 'priority', 'reason', 'created_at']
+QUEUE_EXPRESSIONS = {'patient_phone': F('session__phone_number')}
+
+# Admin dashboard figures may be this many seconds stale
+DASHBOARD_CACHE_KEY = 'admin_dashboard_stats'
+DASHBOARD_CACHE_TIMEOUT = 15
+
+# session_history pages hold at most this many messages
+SESSION_HISTORY_MAX_LIMIT = 500
+
+
+def _isoformat(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+
+def json_bytes(data):
+    """
+    JSON for plain JSON types plus datetimes, which come out as isoformat()
+    strings; orjson (when installed) formats them itself, in C
+    """
+    return orjson.dumps(data) if orjson else json.dumps(data, default=_isoformat).encode()
+
+
+def json_response(data, status=200):
+    """JSON response for json_bytes() payloads (no Decimal/lazy strings)"""
+    return HttpResponse(json_bytes(data), content_type='application/json', status=status)
 
 
 @csrf_exempt
 @require_http_methods(["POST"])
-def whatsapp_webhook(request):
+async def whatsapp_webhook(request):
     """
     Main webhook endpoint for receiving WhatsApp messages from Twilio
+    
+    Async so that under ASGI a worker keeps serving other webhooks while
+    this one waits on the AI reply; the ORM work before and after runs
+    through sync_to_async.
     """
     
-    whatsapp = WhatsAppHandler()
+    whatsapp = get_handler()
     
     # Validate webhook (optional but recommended for production)
     # if not whatsapp.validate_webhook(request):
@@ -29,111 +77,139 @@ def whatsapp_webhook(request):
     
     try:
         # Parse incoming message
-        message_data = whatsapp.parse_incoming_message(request.POST.dict())
+        message_data = whatsapp.parse_incoming_message(request.POST)
         
         from_number = message_data['from']
         user_message = message_data['body']
         message_sid = message_data['message_sid']
         
-        # Initialize session manager
-        session_mgr = SessionManager(from_number)
-        
-        # Log incoming message
-        session_mgr.log_message(
-            content=user_message,
-            is_from_user=True,
-            message_sid=message_sid
+        session_mgr, replies = await sync_to_async(receive_message)(
+            from_number, user_message, message_sid
         )
         
-        # Check if clinician chat is active
-        if session_mgr.get_current_state() == 'CLINICIAN_CHAT_ACTIVE':
-            # Forward message to clinician (via notification system)
-            # For now, just acknowledge receipt
-            response_text = "Your message has been sent to the doctor. They will respond shortly."
-            whatsapp.send_message(from_number, response_text)
-            session_mgr.log_message(response_text, is_from_user=False)
-            return HttpResponse("OK", status=200)
-        
-        # Initialize AI engine
-        ai_engine = AIEngineComplete()
-        
-        # Check if user wants to speak with a clinician immediately
-        if ai_engine.check_for_clinician_request(user_message):
-            return handle_clinician_request(session_mgr, from_number, whatsapp)
-        
-        # Get current state and generate AI response
-        current_state = session_mgr.get_current_state()
-        context = session_mgr.get_full_context()
-        
-        # Generate AI response
-        ai_response = ai_engine.generate_response(context, user_message, current_state)
-        
-        # Handle state transition
-        if ai_response.get('next_state'):
-            session_mgr.transition_to(ai_response['next_state'])
-        
-        # Store any data from AI response
-        if ai_response.get('data_to_store'):
-            for key, value in ai_response['data_to_store'].items():
-                if key == 'profile_field':
-                    # Update profile field
-                    profile_field = value
-                    profile_value = ai_response['data_to_store'].get('value')
-                    session_mgr.update_profile(**{profile_field: profile_value})
-                else:
-                    session_mgr.store_data(key, value)
-        
-        # Handle escalation if needed
-        if ai_response.get('should_escalate'):
-            escalation_reason = ai_response.get('escalation_reason', 'AI determined clinician review needed')
-            ai_assessment = ai_response.get('data_to_store', {}).get('ai_overview', '')
-            
-            escalation = session_mgr.escalate_to_clinician(escalation_reason, ai_assessment)
+        if replies is None:
+            # Get current state and generate AI response
+            current_state = session_mgr.get_current_state()
+            context = await sync_to_async(session_mgr.get_full_context)()
             
-            if escalation.assigned_to:
-                # Clinician assigned immediately
-                response_text = WhatsAppTemplates.clinician_joined(escalation.assigned_to.get_full_name())
-            else:
-                # Added to queue
-                response_text = WhatsAppTemplates.clinician_unavailable()
+            ai_response = await get_ai_engine().agenerate_response(context, user_message, current_state)
             
-            whatsapp.send_message(from_number, response_text)
-            session_mgr.log_message(response_text, is_from_user=False)
+            replies = await sync_to_async(apply_ai_response)(session_mgr, ai_response, whatsapp)
         
-        # If AI generated an assessment, send immediately instead of waiting for next user message
-        if ai_response.get("final_assessment"):
-            assessment_text = ai_response["final_assessment"]
-            
-            whatsapp.send_message(from_number, assessment_text)
-            session_mgr.log_message(assessment_text, is_from_user=False)
-            return HttpResponse("OK", status=200)
-
-        # Otherwise send the normal AI response
-        response_text = ai_response['response']
-
-        if ai_response.get('buttons'):
-            whatsapp.send_message_with_buttons(from_number, response_text, ai_response['buttons'])
-        else:
-            whatsapp.send_message(from_number, response_text)
-
-        session_mgr.log_message(response_text, is_from_user=False)
-
-        return HttpResponse("OK", status=200)
-
+        # Replies go back in the webhook response (TwiML), in order
+        return twiml_reply(whatsapp, *replies)
         
-    except Exception as e:
-        print(f"Error in webhook: {e}")
+    except Exception:
+        logger.exception("Error in webhook")
         # Send error message to user
         try:
-            whatsapp.send_message(from_number, WhatsAppTemplates.error_message())
+            whatsapp.queue_message(from_number, WhatsAppTemplates.error_message())
         except:
             pass
         
         return HttpResponse("Error", status=500)
 
 
-def handle_clinician_request(session_mgr, from_number, whatsapp):
-    """Handle immediate clinician connection request"""
+def receive_message(from_number, user_message, message_sid):
+    """
+    Log an incoming message and answer it if that needs no AI call.
+    Returns the SessionManager and the replies, or None for the replies
+    when the AI should answer.
+    """
+    
+    # Initialize session manager
+    session_mgr = SessionManager(from_number)
+    
+    # Log incoming message; a repeated SID is a Twilio retry we already handled
+    if session_mgr.log_message(
+        content=user_message,
+        is_from_user=True,
+        message_sid=message_sid
+    ) is None:
+        return session_mgr, []
+    
+    # Check if clinician chat is active
+    if session_mgr.get_current_state() == 'CLINICIAN_CHAT_ACTIVE':
+        # Forward message to clinician (via notification system)
+        # For now, just acknowledge receipt
+        response_text = "Your message has been sent to the doctor. They will respond shortly."
+        session_mgr.log_message(response_text, is_from_user=False)
+        return session_mgr, [response_text]
+    
+    # Check if user wants to speak with a clinician immediately
+    if get_ai_engine().check_for_clinician_request(user_message):
+        return session_mgr, [handle_clinician_request(session_mgr)]
+    
+    return session_mgr, None
+
+
+def apply_ai_response(session_mgr, ai_response, whatsapp):
+    """Store what the AI reply changes on the session; returns the replies to send"""
+    
+    replies = []
+    
+    # Handle state transition
+    if ai_response.get('next_state'):
+        session_mgr.transition_to(ai_response['next_state'])
+    
+    # Store any data from AI response
+    if ai_response.get('data_to_store'):
+        for key, value in ai_response['data_to_store'].items():
+            if key == 'profile_field':
+                # Update profile field
+                profile_field = value
+                profile_value = ai_response['data_to_store'].get('value')
+                session_mgr.update_profile(**{profile_field: profile_value})
+            else:
+                session_mgr.store_data(key, value)
+    
+    # Handle escalation if needed
+    if ai_response.get('should_escalate'):
+        escalation_reason = ai_response.get('escalation_reason', 'AI determined clinician review needed')
+        ai_assessment = ai_response.get('data_to_store', {}).get('ai_overview', '')
+        
+        escalation = session_mgr.escalate_to_clinician(escalation_reason, ai_assessment)
+        
+        if escalation.assigned_to:
+            # Clinician assigned immediately
+            response_text = WhatsAppTemplates.clinician_joined(escalation.assigned_to.get_full_name())
+        else:
+            # Added to queue
+            response_text = WhatsAppTemplates.clinician_unavailable()
+        
+        replies.append(response_text)
+    
+    # If AI generated an assessment, send immediately instead of waiting for next user message
+    if ai_response.get("final_assessment"):
+        replies.append(ai_response["final_assessment"])
+        session_mgr.log_replies(replies)
+        return replies
+    
+    # Otherwise send the normal AI response
+    response_text = ai_response['response']
+    
+    # All of this webhook's replies are logged in one INSERT
+    session_mgr.log_replies([*replies, response_text])
+    
+    if ai_response.get('buttons'):
+        replies.append(whatsapp.format_with_buttons(response_text, ai_response['buttons']))
+    else:
+        replies.append(response_text)
+    
+    return replies
+
+
+def twiml_reply(whatsapp, *messages):
+    """
+    Webhook response carrying `messages` as TwiML; Twilio delivers them
+    without a REST call. Always a new HttpResponse: middleware sets headers
+    and cookies on it, so one instance can't be shared between requests.
+    """
+    return HttpResponse(whatsapp.create_response(*messages), content_type='text/xml')
+
+
+def handle_clinician_request(session_mgr):
+    """Handle immediate clinician connection request; returns the reply"""
     
     # Transition to clinician connection state
     session_mgr.transition_to('CONNECT_TO_CLINICIAN')
@@ -143,7 +219,7 @@ def handle_clinician_request(session_mgr, from_number, whatsapp):
     context = session_mgr.get_full_context()
     
     # Generate quick AI overview
-    ai_engine = AIEngineComplete()
+    ai_engine = get_ai_engine()
     conversation_summary = "\n".join([
         msg['content'] for msg in context['conversation_history'][-5:]
         if msg['is_from_user']
@@ -159,10 +235,9 @@ def handle_clinician_request(session_mgr, from_number, whatsapp):
     else:
         response_text = WhatsAppTemplates.escalation_message()
     
-    whatsapp.send_message(from_number, response_text)
     session_mgr.log_message(response_text, is_from_user=False)
     
-    return HttpResponse("OK", status=200)
+    return response_text
 
 
 # ===== API ENDPOINTS FOR CLINICIAN PORTAL =====
@@ -173,42 +248,26 @@ def clinician_queue(request):
     """Get escalation queue for clinician"""
     
     clinician = request.user
-    escalation_mgr = ClinicianEscalation()
+    escalation_mgr = get_escalation_manager()
     
     # Get assigned cases
-    assigned_cases = escalation_mgr.get_clinician_queue(clinician)
+    assigned_cases = escalation_mgr.get_clinician_queue(clinician).values(
+        *QUEUE_FIELDS, **QUEUE_EXPRESSIONS
+    )
     
     # Get pending cases (if admin/supervisor)
     if request.user.is_staff:
-        pending_cases = escalation_mgr.get_pending_escalations()
+        pending_cases = escalation_mgr.get_pending_escalations().values(
+            *PENDING_QUEUE_FIELDS, **QUEUE_EXPRESSIONS
+        )
     else:
         pending_cases = []
     
-    # Format response
-    assigned_data = [
-        {
-            'id': case.id,
-            'patient_phone': case.session.phone_number,
-            'priority': case.priority,
-            'reason': case.reason,
-            'created_at': case.created_at.isoformat(),
-            'assigned_at': case.assigned_at.isoformat() if case.assigned_at else None
-        }
-        for case in assigned_cases
-    ]
-    
-    pending_data = [
-        {
-            'id': case.id,
-            'patient_phone': case.session.phone_number,
-            'priority': case.priority,
-            'reason': case.reason,
-            'created_at': case.created_at.isoformat()
-        }
-        for case in pending_cases
-    ]
+    # The rows are already the response items; datetimes are left to the serializer
+    assigned_data = list(assigned_cases)
+    pending_data = list(pending_cases)
     
-    return JsonResponse({
+    return json_response({
         'assigned_cases': assigned_data,
         'pending_cases': pending_data
     })
@@ -219,13 +278,13 @@ def clinician_queue(request):
 def case_detail(request, case_id):
     """Get detailed information about a specific case"""
     
-    escalation = get_object_or_404(EscalationQueue, id=case_id)
+    escalation = get_object_or_404(EscalationQueue.objects.select_related('session'), id=case_id)
     
     # Check permissions
     if escalation.assigned_to != request.user and not request.user.is_staff:
         return JsonResponse({'error': 'Unauthorized'}, status=403)
     
-    escalation_mgr = ClinicianEscalation()
+    escalation_mgr = get_escalation_manager()
     summary = escalation_mgr.get_escalation_summary(escalation)
     
     return JsonResponse(summary)
@@ -237,13 +296,14 @@ def send_clinician_message(request, case_id):
     """Send a message from clinician to patient"""
     
     try:
-        data = json.loads(request.body)
+        # orjson.JSONDecodeError subclasses json.JSONDecodeError
+        data = orjson.loads(request.body) if orjson else json.loads(request.body)
         message = data.get('message')
         
         if not message:
             return JsonResponse({'error': 'Message is required'}, status=400)
         
-        escalation = get_object_or_404(EscalationQueue, id=case_id)
+        escalation = get_object_or_404(EscalationQueue.objects.select_related('session'), id=case_id)
         
         # Check permissions
         if escalation.assigned_to != request.user:
@@ -269,23 +329,53 @@ def send_clinician_message(request, case_id):
 def accept_case(request, case_id):
     """Clinician accepts a pending case"""
     
-    escalation = get_object_or_404(EscalationQueue, id=case_id)
+    escalation = get_object_or_404(EscalationQueue.objects.select_related('session'), id=case_id)
     
-    if escalation.assigned_to:
+    if escalation.assigned_to_id:
         return JsonResponse({'error': 'Case already assigned'}, status=400)
     
-    escalation_mgr = ClinicianEscalation()
-    success = escalation_mgr.assign_to_clinician(escalation, request.user)
+    escalation_mgr = get_escalation_manager()
+    result = escalation_mgr.assign_to_clinician(escalation, request.user)
     
-    if success:
+    if result is AssignResult.ASSIGNED:
         # Notify patient
-        whatsapp = WhatsAppHandler()
+        whatsapp = get_handler()
         message = WhatsAppTemplates.clinician_joined(request.user.get_full_name())
-        whatsapp.send_message(escalation.session.phone_number, message)
+        whatsapp.queue_message(escalation.session.phone_number, message)
         
         return JsonResponse({'status': 'Case accepted'})
-    else:
+    if result is AssignResult.TAKEN:
+        # Claimed by another clinician between the check above and the UPDATE
+        return JsonResponse({'error': 'Case already assigned'}, status=400)
+    if result is AssignResult.AT_CAPACITY:
+        return JsonResponse({'error': 'At capacity'}, status=409)
+    return JsonResponse({'error': 'Failed to accept case'}, status=500)
+
+
+@login_required
+@require_http_methods(["POST"])
+def accept_next_case(request):
+    """Clinician takes the highest-priority pending case"""
+    
+    escalation_mgr = get_escalation_manager()
+    result, escalation = escalation_mgr.assign_next_pending(request.user)
+    
+    if result is AssignResult.NONE_PENDING:
+        return JsonResponse({'error': 'No pending case available'}, status=404)
+    if result is AssignResult.AT_CAPACITY:
+        return JsonResponse({'error': 'At capacity'}, status=409)
+    if result is AssignResult.TAKEN:
+        # Only without row locks (SQLite): another pickup claimed it first
+        return JsonResponse({'error': 'Case already assigned'}, status=409)
+    if result is not AssignResult.ASSIGNED:
         return JsonResponse({'error': 'Failed to accept case'}, status=500)
+    
+    # Notify patient
+    whatsapp = get_handler()
+    message = WhatsAppTemplates.clinician_joined(request.user.get_full_name())
+    whatsapp.queue_message(escalation.session.phone_number, message)
+    
+    return JsonResponse({'status': 'Case accepted', 'case_id': escalation.id})
 
 
 @login_required
@@ -293,18 +383,19 @@ def accept_case(request, case_id):
 def resolve_case(request, case_id):
     """Mark a case as resolved"""
     
-    escalation = get_object_or_404(EscalationQueue, id=case_id)
+    escalation = get_object_or_404(EscalationQueue.objects.select_related('session'), id=case_id)
     
     # Check permissions
     if escalation.assigned_to != request.user and not request.user.is_staff:
         return JsonResponse({'error': 'Unauthorized'}, status=403)
     
-    escalation_mgr = ClinicianEscalation()
-    escalation_mgr.resolve_escalation(escalation)
+    escalation_mgr = get_escalation_manager()
+    if not escalation_mgr.resolve_escalation(escalation):
+        return JsonResponse({'error': 'Case already resolved'}, status=400)
     
     # Send closing message to patient
-    whatsapp = WhatsAppHandler()
-    whatsapp.send_message(
+    whatsapp = get_handler()
+    whatsapp.queue_message(
         escalation.session.phone_number,
         WhatsAppTemplates.session_complete()
     )
@@ -315,36 +406,61 @@ def resolve_case(request, case_id):
 @login_required
 @require_http_methods(["GET"])
 def session_history(request, phone_number):
-    """Get conversation history for a patient"""
+    """
+    Get conversation history for a patient, a page at a time
+    
+    A page is the newest `limit` messages (default and maximum
+    SESSION_HISTORY_MAX_LIMIT) with id below `before_id`, oldest first.
+    `next_before_id` is the `before_id` for the page before it, or null
+    once the page reaches the first message.
+    """
+    
+    try:
+        limit = int(request.GET['limit']) if request.GET.get('limit') else SESSION_HISTORY_MAX_LIMIT
+        before_id = int(request.GET['before_id']) if request.GET.get('before_id') else None
+    except ValueError:
+        return JsonResponse({'error': 'limit and before_id must be integers'}, status=400)
+    limit = min(max(limit, 1), SESSION_HISTORY_MAX_LIMIT)
     
     try:
         session = PatientSession.objects.get(phone_number=phone_number)
-        messages = MessageLog.objects.filter(session=session).order_by('created_at')
-        
-        history = [
-            {
-                'content': msg.content,
-                'is_from_user': msg.is_from_user,
-                'is_from_clinician': msg.is_from_clinician,
-                'clinician': msg.clinician.get_full_name() if msg.clinician else None,
-                'timestamp': msg.created_at.isoformat()
-            }
-            for msg in messages
-        ]
-        
-        return JsonResponse({
-            'phone_number': phone_number,
-            'history': history,
-            'profile': {
-                'age': session.age,
-                'gender': session.gender,
-                'weight': session.weight,
-                'medical_history': session.medical_history
-            }
-        })
-        
     except PatientSession.DoesNotExist:
         return JsonResponse({'error': 'Session not found'}, status=404)
+    
+    # Plain rows with the clinician's name joined in; no per-message User lookups
+    messages = MessageLog.objects.filter(session=session).values(
+        'id', 'content', 'is_from_user', 'is_from_clinician', 'created_at',
+        clinician_name=full_name('clinician')
+    )
+    if before_id is not None:
+        messages = messages.filter(id__lt=before_id)
+    
+    # One extra row tells whether there is an older page
+    page = list(messages.order_by('-id')[:limit + 1])
+    next_before_id = page[limit - 1]['id'] if len(page) > limit else None
+    
+    history = [
+        {
+            'content': msg['content'],
+            'is_from_user': msg['is_from_user'],
+            'is_from_clinician': msg['is_from_clinician'],
+            'clinician': msg['clinician_name'],
+            'timestamp': msg['created_at']
+        }
+        for msg in reversed(page[:limit])
+    ]
+    
+    return json_response({
+        'phone_number': phone_number,
+        'history': history,
+        'next_before_id': next_before_id,
+        'profile': {
+            'age': session.age,
+            'gender': session.gender,
+            'weight': session.weight,
+            'medical_history': session.medical_history
+        }
+    })
 
 
 # ===== ADMIN ENDPOINTS =====
@@ -357,6 +473,14 @@ def admin_dashboard(request):
     if not request.user.is_staff:
         return JsonResponse({'error': 'Unauthorized'}, status=403)
     
+    # Polled by the dashboard UI; every poller within the TTL shares one computation
+    stats = cache.get_or_set(DASHBOARD_CACHE_KEY, dashboard_stats, DASHBOARD_CACHE_TIMEOUT)
+    
+    return JsonResponse(stats)
+
+
+def dashboard_stats():
+    """Figures shown on the admin dashboard"""
     from django.db.models import Count, Q
     from datetime import timedelta
     from django.utils import timezone
@@ -365,36 +489,37 @@ def admin_dashboard(request):
     today = timezone.now().date()
     week_ago = timezone.now() - timedelta(days=7)
     
-    stats = {
-        'active_sessions': PatientSession.objects.filter(
+    # One conditional-count query per table instead of a COUNT(*) per figure
+    sessions = PatientSession.objects.aggregate(
+        total=Count('pk'),
+        active=Count('pk', filter=Q(
             state__in=['COLLECTING_SYMPTOMS', 'AI_FOLLOWUP_QUESTIONS', 'CLINICIAN_CHAT_ACTIVE']
-        ).count(),
+        )),
+        today=Count('pk', filter=Q(created_at__date=today)),
+        this_week=Count('pk', filter=Q(created_at__gte=week_ago)),
+        escalated=Count('pk', filter=Q(escalated_to_clinician=True)),
+    )
+    
+    stats = {
+        'active_sessions': sessions['active'],
         'pending_escalations': EscalationQueue.objects.filter(
             is_resolved=False,
             assigned_to__isnull=True
         ).count(),
-        'sessions_today': PatientSession.objects.filter(
-            created_at__date=today
-        ).count(),
-        'sessions_this_week': PatientSession.objects.filter(
-            created_at__gte=week_ago
-        ).count(),
-        'escalation_rate': calculate_escalation_rate(),
+        'sessions_today': sessions['today'],
+        'sessions_this_week': sessions['this_week'],
+        'escalation_rate': calculate_escalation_rate(sessions['total'], sessions['escalated']),
         'available_clinicians': ClinicianAvailability.objects.filter(
             is_available=True
         ).count()
     }
     
-    return JsonResponse(stats)
+    return stats
 
 
-def calculate_escalation_rate():
+def calculate_escalation_rate(total, escalated):
     """Calculate percentage of sessions that get escalated"""
-    from django.db.models import Count
-    
-    total = PatientSession.objects.count()
     if total == 0:
         return 0
     
-    escalated = PatientSession.objects.filter(escalated_to_clinician=True).count()
     return round((escalated / total) * 100, 2)
\ No newline at end of file
@@ -1,9 +1,93 @@
 # lifegate/whatsapp_handler.py
 
+import atexit
+import base64
+import hashlib
+import hmac
+import logging
 import os
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from twilio.request_validator import RequestValidator
 from twilio.rest import Client
 from twilio.twiml.messaging_response import MessagingResponse
 
+logger = logging.getLogger(__name__)
+
+# Keep-alive pool for api.twilio.com, sized for concurrent webhook workers
+TWILIO_POOL_CONNECTIONS = 20
+TWILIO_POOL_MAXSIZE = 50
+
+# Threads making outbound Twilio calls, so requests don't wait on them
+SEND_WORKERS = 8
+
+# Text queued for one recipient within this window goes out as one message
+WEBHOOK_BATCH_TIMEOUT_SECONDS = 0.1
+
+# Most recent queued send per recipient, so their messages stay in order
+_last_send = {}
+_last_send_lock = threading.Lock()
+
+# Body of a reply with no messages, e.g. to a retried webhook already handled
+EMPTY_TWIML = str(MessagingResponse())
+
+
+@lru_cache(maxsize=1)
+def _get_send_pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=SEND_WORKERS, thread_name_prefix="twilio-send")
+
+
+def _forget_send(to_number, future):
+    with _last_send_lock:
+        if _last_send.get(to_number) is future:
+            del _last_send[to_number]
+
+
+class MessageBatcher:
+    """
+    Collects messages per recipient for a short window, then hands each
+    recipient's batch to `send(to_number, body)` as a single body.
+    Identical adjacent messages are only sent once.
+    """
+    
+    def __init__(self, send, timeout: float = WEBHOOK_BATCH_TIMEOUT_SECONDS):
+        self.send = send
+        self.timeout = timeout
+        self._pending = defaultdict(list)
+        self._timers = {}
+        self._lock = threading.Lock()
+    
+    def add(self, to_number: str, message: str):
+        with self._lock:
+            pending = self._pending[to_number]
+            if not pending or pending[-1] != message:
+                pending.append(message)
+            if to_number not in self._timers:
+                timer = threading.Timer(self.timeout, self.flush, args=(to_number,))
+                timer.daemon = True
+                self._timers[to_number] = timer
+                timer.start()
+    
+    def flush(self, to_number: str, send=None):
+        """Send whatever is pending for `to_number` now (through `send` if given)"""
+        with self._lock:
+            timer = self._timers.pop(to_number, None)
+            messages = self._pending.pop(to_number, None)
+        if timer is not None:
+            timer.cancel()
+        if messages:
+            (send or self.send)(to_number, "\n\n".join(messages))
+    
+    def flush_all(self, send=None):
+        with self._lock:
+            numbers = list(self._pending)
+        for to_number in numbers:
+            self.flush(to_number, send)
+
+
 class WhatsAppHandler:
     """Handles WhatsApp messaging via Twilio API"""
     
@@ -11,12 +95,22 @@ class WhatsAppHandler:
         self.account_sid = os.environ.get('TWILIO_ACCOUNT_SID')
         self.auth_token = os.environ.get('TWILIO_AUTH_TOKEN')
         self.whatsapp_number = os.environ.get('TWILIO_WHATSAPP_NUMBER')  # Format: whatsapp:+1234567890
+        self._auth_token_bytes = self.auth_token.encode() if self.auth_token else None
         
         if self.account_sid and self.auth_token:
             self.client = Client(self.account_sid, self.auth_token)
+            self.client.http_client.session.mount('https://', HTTPAdapter(
+                pool_connections=TWILIO_POOL_CONNECTIONS,
+                pool_maxsize=TWILIO_POOL_MAXSIZE
+            ))
         else:
             self.client = None
-            print("Warning: Twilio credentials not configured")
+            logger.warning("Twilio credentials not configured")
+        
+        self.batcher = MessageBatcher(self._submit_send)
+        # The send pool is already shut down by the time atexit runs,
+        # so anything still batched is sent inline
+        atexit.register(self.batcher.flush_all, self.send_message)
     
     def send_message(self, to_number: str, message: str, media_url: str = None):
         """
@@ -29,7 +123,7 @@ class WhatsAppHandler:
         """
         
         if not self.client:
-            print(f"[MOCK] Would send to {to_number}: {message}")
+            logger.info("[MOCK] Would send to %s: %s", to_number, message)
             return None
         
         # Ensure proper WhatsApp format
@@ -55,9 +149,38 @@ class WhatsAppHandler:
             }
             
         except Exception as e:
-            print(f"Error sending WhatsApp message: {e}")
+            logger.error("Error sending WhatsApp message: %s", e)
             return None
     
+    def queue_message(self, to_number: str, message: str, media_url: str = None, buttons: list = None):
+        """
+        Send a WhatsApp message from a background thread, returning at once.
+        Text queued for the same number within WEBHOOK_BATCH_TIMEOUT_SECONDS
+        is coalesced into one message; a number's messages go out in order.
+        """
+        if media_url:
+            # Media can't be merged into a text body; send what's batched first
+            self.batcher.flush(to_number)
+            self._submit_send(to_number, message, media_url)
+        else:
+            self.batcher.add(to_number, self.format_with_buttons(message, buttons))
+    
+    def _submit_send(self, to_number: str, message: str, media_url: str = None):
+        with _last_send_lock:
+            previous = _last_send.get(to_number)
+            future = _get_send_pool().submit(
+                self._send_after, previous, to_number, message, media_url
+            )
+            _last_send[to_number] = future
+        future.add_done_callback(lambda done: _forget_send(to_number, done))
+        return future
+    
+    def _send_after(self, previous, to_number, message, media_url):
+        # `previous` was submitted first, so it is already running or done
+        if previous is not None:
+            previous.exception()
+        return self.send_message(to_number, message, media_url)
+    
     def send_message_with_buttons(self, to_number: str, message: str, buttons: list):
         """
         Send a message with interactive buttons
@@ -69,57 +192,63 @@ class WhatsAppHandler:
             buttons: List of button labels
         """
         
+        return self.send_message(to_number, self.format_with_buttons(message, buttons))
+    
+    def format_with_buttons(self, message: str, buttons: list) -> str:
+        """Message text with the button labels listed under it"""
+        
         # For basic Twilio WhatsApp, we append button options to the message
         # More advanced button support requires WhatsApp Business API
         
         if buttons:
-            button_text = "\n\n" + "\n".join([f"• {btn}" for btn in buttons])
-            full_message = message + button_text
-        else:
-            full_message = message
-        
-        return self.send_message(to_number, full_message)
+            button_text = "\n\n" + "\n".join(f"• {btn}" for btn in buttons)
+            return message + button_text
+        return message
     
-    def parse_incoming_message(self, request_data: dict) -> dict:
+    def parse_incoming_message(self, request_data) -> dict:
         """
         Parse incoming webhook data from Twilio
         
         Args:
-            request_data: POST data from Twilio webhook
+            request_data: POST data from Twilio webhook (request.POST as-is;
+                any mapping with .get() works)
             
         Returns:
             dict with parsed message data
         """
         
         # Extract phone number (remove 'whatsapp:' prefix)
-        from_number = request_data.get('From', '')
-        if from_number.startswith('whatsapp:'):
-            from_number = from_number.replace('whatsapp:', '')
+        from_number = request_data.get('From', '').removeprefix('whatsapp:')
+        num_media = int(request_data.get('NumMedia', 0))
         
         return {
             'from': from_number,
             'body': request_data.get('Body', ''),
             'message_sid': request_data.get('MessageSid', ''),
-            'num_media': int(request_data.get('NumMedia', 0)),
-            'media_url': request_data.get('MediaUrl0') if int(request_data.get('NumMedia', 0)) > 0 else None,
+            'num_media': num_media,
+            'media_url': request_data.get('MediaUrl0') if num_media > 0 else None,
             'profile_name': request_data.get('ProfileName', ''),
             'wa_id': request_data.get('WaId', '')
         }
     
-    def create_response(self, message: str) -> str:
+    def create_response(self, *messages: str) -> str:
         """
         Create a TwiML response for immediate webhook reply
         (Alternative to sending via API)
         
         Args:
-            message: Response message
+            messages: Response messages, delivered in order (none for an empty reply)
             
         Returns:
             TwiML XML string
         """
         
+        if not messages:
+            return EMPTY_TWIML
+        
         response = MessagingResponse()
-        response.message(message)
+        for message in messages:
+            response.message(message)
         return str(response)
     
     def validate_webhook(self, request):
@@ -132,23 +261,31 @@ class WhatsAppHandler:
         Returns:
             bool: True if valid Twilio request
         """
-        from twilio.request_validator import RequestValidator
-        
         if not self.auth_token:
             return True  # Skip validation in dev mode
         
-        validator = RequestValidator(self.auth_token)
-        
         # Get the URL Twilio used to make the request
         url = request.build_absolute_uri()
         
-        # Get POST data
-        post_data = request.POST.dict()
-        
         # Get X-Twilio-Signature header
         signature = request.META.get('HTTP_X_TWILIO_SIGNATURE', '')
         
-        return validator.validate(url, post_data, signature)
+        # Fast path: one HMAC over the URL exactly as received, compared in
+        # constant time. Parameters are canonicalised the way Twilio signs
+        # them: sorted names, each followed by its sorted distinct values.
+        post = request.POST
+        canonical = url + "".join(
+            name + value
+            for name in sorted(post)
+            for value in sorted(set(post.getlist(name)))
+        )
+        mac = hmac.new(self._auth_token_bytes, canonical.encode(), hashlib.sha1)
+        if hmac.compare_digest(base64.b64encode(mac.digest()), signature.encode()):
+            return True
+        
+        # Twilio may have signed the URL with or without an explicit port;
+        # the SDK validator tries both
+        return RequestValidator(self.auth_token).validate(url, post, signature)
     
     def send_typing_indicator(self, to_number: str):
         """
@@ -169,33 +306,46 @@ class WhatsAppHandler:
             Formatted message string
         """
         
-        parts = []
-        
-        if content.get('title'):
-            parts.append(f"*{content['title']}*")
-            parts.append("")
-        
-        if content.get('body'):
-            parts.append(content['body'])
-            parts.append("")
+        sections = [
+            f"*{content['title']}*" if content.get('title') else None,
+            content.get('body'),
+            "\n".join(f"• {bullet}" for bullet in content.get('bullets') or ()),
+            f"_{content['footer']}_" if content.get('footer') else None,
+        ]
+        message = "\n\n".join(filter(None, sections))
         
-        if content.get('bullets'):
-            for bullet in content['bullets']:
-                parts.append(f"• {bullet}")
-            parts.append("")
-        
-        if content.get('footer'):
-            parts.append(f"_{content['footer']}_")
-        
-        return "\n".join(parts)
+        # Every section but the footer is followed by a blank line
+        if message and not content.get('footer'):
+            message += "\n"
+        return message
+
+
+@lru_cache(maxsize=1)
+def get_handler() -> WhatsAppHandler:
+    """
+    Process-wide handler, so the Twilio client and its pooled HTTPS
+    connections are reused across requests instead of rebuilt per webhook.
+    """
+    return WhatsAppHandler()
+
+
+def _reset_after_fork():
+    global _last_send_lock
+    get_handler.cache_clear()
+    _get_send_pool.cache_clear()
+    _last_send.clear()
+    _last_send_lock = threading.Lock()
+
+
+# Sockets and threads must not be shared across a fork (e.g. preforking workers)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
 
 
 class WhatsAppTemplates:
     """Pre-defined message templates for consistency"""
     
-    @staticmethod
-    def welcome_message():
-        return """Welcome to Lifegate! 👋
+    WELCOME = """Welcome to Lifegate! 👋
 
 I'm your AI health assistant. I can help you:
 • Understand your symptoms
@@ -206,41 +356,53 @@ All conversations are confidential and secure.
 
 Reply 'Start' to begin, or type 'Doctor' anytime to speak with a clinician directly."""
     
-    @staticmethod
-    def escalation_message():
-        return """I'll connect you with a clinician right away. 
+    ESCALATION = """I'll connect you with a clinician right away. 
 
 A doctor will join this chat shortly. Please wait a moment...
 
 ⏱️ Average wait time: 2-5 minutes"""
     
-    @staticmethod
-    def clinician_joined(clinician_name: str):
-        return f"""Dr. {clinician_name} has joined the chat. 👨‍⚕️
-
-You can now discuss your concerns directly with the doctor."""
-    
-    @staticmethod
-    def session_complete():
-        return """Thank you for using Lifegate! 
+    SESSION_COMPLETE = """Thank you for using Lifegate! 
 
 Take care and feel better soon. If you need assistance again, just send us a message anytime. 🌟
 
 Stay healthy!"""
     
-    @staticmethod
-    def error_message():
-        return """I apologize, but I'm having trouble processing your request right now. 
+    ERROR = """I apologize, but I'm having trouble processing your request right now. 
 
 Please try again in a moment, or type 'Doctor' to speak with a clinician directly."""
     
-    @staticmethod
-    def clinician_unavailable():
-        return """All our clinicians are currently busy. 
+    CLINICIAN_UNAVAILABLE = """All our clinicians are currently busy. 
 
 We've added you to the queue and a doctor will reach out as soon as possible.
 
 Priority: Based on your symptoms
 Expected wait: 10-15 minutes
 
-You'll receive a message when a clinician is available."""
\ No newline at end of file
+You'll receive a message when a clinician is available."""
+    
+    @staticmethod
+    def welcome_message():
+        return WhatsAppTemplates.WELCOME
+    
+    @staticmethod
+    def escalation_message():
+        return WhatsAppTemplates.ESCALATION
+    
+    @staticmethod
+    def clinician_joined(clinician_name: str):
+        return f"""Dr. {clinician_name} has joined the chat. 👨‍⚕️
+
+You can now discuss your concerns directly with the doctor."""
+    
+    @staticmethod
+    def session_complete():
+        return WhatsAppTemplates.SESSION_COMPLETE
+    
+    @staticmethod
+    def error_message():
+        return WhatsAppTemplates.ERROR
+    
+    @staticmethod
+    def clinician_unavailable():
+        return WhatsAppTemplates.CLINICIAN_UNAVAILABLE
\ No newline at end of file